@@ -34,6 +34,17 @@ CONSTRUCT_YAML_DIR="${HOME_DIR}"/workspace/build-scripts-cron/constructor
 
 CONSTRUCTOR_OUTPUT_FILENAME="eman2.${os_label}.${ctor_out_ext}"
 
+# With a build service running (legacy/build.py serve), only queue this job.
+# The service runs this script again with EMAN2_BUILD_JOB set, coalesces
+# requests for the same branch head, and runs jobs sharing the checkout one at a time.
+if [ -n "${EMAN2_BUILD_SOCKET}" ] && [ -z "${EMAN2_BUILD_JOB}" ];then
+    commit=$(cd "${EMAN_REPO_DIR}" && git ls-remote origin "${branch}" | cut -f 1)
+    exec "${PYTHON:-python}" "${MYDIR}/legacy/build.py" submit --socket "${EMAN2_BUILD_SOCKET}" \
+                                                       --exec --key "${distro_label}:${branch}:${commit}" \
+                                                       --lock "${EMAN_REPO_DIR}" \
+                                                       -- bash "${MYDIR}/$(basename ${0})" "$@"
+fi
+
 # Checkout code
 cd "${EMAN_REPO_DIR}"
 git fetch --prune
@@ -35,25 +35,646 @@ import glob
 import datetime
 import argparse
 import platform
+import stat
+import errno
+import threading
+import collections
+import struct
+import mmap
+import json
+import functools
+import contextlib
+import gzip
+import time
+import resource
+import sqlite3
+import Queue
+import fcntl
+import tempfile
+import tarfile
+import zlib
+import hashlib
+import distutils.spawn
+import pipes
+import ast
+import fnmatch
+import zipfile
+import socket
+import signal
+import SocketServer
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 ##### Helper functions #####
 def log(msg):
     """Print a message."""
     print "=====", msg, "====="
+    steplog = current_step_log()
+    if steplog:
+        steplog.write("===== %s =====\n"%msg)
+
+##### Stage file index #####
+
+# File kinds recorded in the StageIndex, classified by magic bytes.
+ELF = 'elf'
+MACHO = 'macho'
+SCRIPT = 'script'
+OTHER = 'other'
+
+MACHO_MAGICS = set([
+    '\xfe\xed\xfa\xce', '\xce\xfa\xed\xfe', # 32-bit
+    '\xfe\xed\xfa\xcf', '\xcf\xfa\xed\xfe', # 64-bit
+])
+FAT_MAGIC = '\xca\xfe\xba\xbe'
+
+StageFile = collections.namedtuple('StageFile', ['path', 'relpath', 'kind', 'mode', 'size', 'mtime', 'nlink', 'shebang'])
+
+def classify(path):
+    """Classify a file by its magic bytes. Returns (kind, shebang line or None)."""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(8)
+            if head[:4] == '\x7fELF':
+                return ELF, None
+            if head[:4] in MACHO_MAGICS:
+                return MACHO, None
+            # Java class files share the fat magic; they have a large version number where
+            # a universal binary has its (small) architecture count.
+            if head[:4] == FAT_MAGIC and len(head) == 8 and 0 < int(head[4:8].encode('hex'), 16) < 30:
+                return MACHO, None
+            if head[:2] == '#!':
+                f.seek(0)
+                return SCRIPT, f.readline(1024).rstrip('\r\n')
+    except (IOError, OSError):
+        pass
+    return OTHER, None
+
+def vanished(e):
+    """True for an OSError raised because a file was removed since it was listed."""
+    return e.errno == errno.ENOENT
+
+def walk_files(root):
+    """Yield (path, lstat) for every regular file below root, without following symlinks.
+
+    Files removed or renamed while the walk runs (e.g. by a concurrent step) are skipped.
+    """
+    stack = [root]
+    while stack:
+        top = stack.pop()
+        if scandir:
+            try:
+                entries = [(e.path, e.is_dir(follow_symlinks=False), e) for e in scandir(top)]
+            except OSError:
+                continue
+            for path, isdir, e in entries:
+                if isdir:
+                    stack.append(path)
+                elif e.is_file(follow_symlinks=False):
+                    try:
+                        st = e.stat(follow_symlinks=False)
+                    except OSError, err:
+                        if vanished(err):
+                            continue
+                        raise
+                    yield path, st
+        else:
+            try:
+                names = os.listdir(top)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(top, name)
+                try:
+                    st = os.lstat(path)
+                except OSError, err:
+                    if vanished(err):
+                        continue
+                    raise
+                if stat.S_ISDIR(st.st_mode):
+                    stack.append(path)
+                elif stat.S_ISREG(st.st_mode):
+                    yield path, st
+
+class StageIndex(object):
+    """Classification of every regular file below a root, built with a single tree walk.
+
+    The index is shared by all Builders in a run (see stage_index()) and is only
+    rebuilt after it has been invalidated by a step that writes to the tree.
+    Steps that modify files in place without adding or removing any can
+    update the affected entries with refresh().
+    """
 
-def find_exec(root='.'):
-    """Find executables (using +x permissions)."""
-    # find . -type f -perm +111 -print
-    p = check_output(['find', root,'-executable']) # '-type', 'f', '-perm', '+111'])
-    # unix find may print empty lines; strip those out.
-    return filter(None, [i.strip() for i in p.split("\n")])
+    def __init__(self, root):
+        self.root = root
+        self._files = None
+        self._lock = threading.RLock()
+
+    def _entry(self, path, st):
+        kind, shebang = classify(path)
+        relpath = os.path.relpath(path, self.root)
+        return StageFile(path, relpath, kind, st.st_mode, st.st_size, st.st_mtime, st.st_nlink, shebang)
+
+    def scan(self):
+        """Walk the tree and classify each file."""
+        with self._lock:
+            files = {}
+            for path, st in walk_files(self.root):
+                files[path] = self._entry(path, st)
+            self._files = files
+            return files
+
+    def invalidate(self):
+        with self._lock:
+            self._files = None
+
+    def refresh(self, path):
+        """Update the entry for a single file after it was modified in place."""
+        with self._lock:
+            if self._files is None:
+                return
+            try:
+                self._files[path] = self._entry(path, os.lstat(path))
+            except OSError:
+                self._files.pop(path, None)
+
+    def files(self):
+        """All StageFile entries, sorted by path."""
+        with self._lock:
+            files = self._files
+            if files is None:
+                files = self.scan()
+            return [files[k] for k in sorted(files)]
+
+_stage_indexes = {}
+_stage_indexes_lock = threading.Lock()
+
+def stage_index(root):
+    """Return the shared StageIndex for a root directory."""
+    root = os.path.abspath(root)
+    with _stage_indexes_lock:
+        if root not in _stage_indexes:
+            _stage_indexes[root] = StageIndex(root)
+        return _stage_indexes[root]
+
+##### ELF #####
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_NOTE = 4
+
+NT_GNU_BUILD_ID = 3
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_STRSZ = 10
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+Segment = collections.namedtuple('Segment', ['type', 'offset', 'vaddr', 'filesz'])
+
+class ElfFile(object):
+    """Minimal mmap-backed ELF reader/writer for the dynamic section.
+
+    Only what the post-install steps need is parsed: the program headers,
+    the dynamic entries and the dynamic string table. Use as a context manager.
+    """
+
+    def __init__(self, path, write=False):
+        self.path = path
+        self._f = open(path, 'r+b' if write else 'rb')
+        try:
+            self.map = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_WRITE if write else mmap.ACCESS_READ)
+        except Exception:
+            self._f.close()
+            raise
+        try:
+            self._parse()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.map.close()
+        self._f.close()
+
+    def _unpack(self, fmt, offset):
+        return struct.unpack_from(self.endian+fmt, self.map, offset)
+
+    def _parse(self):
+        if self.map[:4] != '\x7fELF':
+            raise ValueError("Not an ELF file: %s"%self.path)
+        elfclass, elfdata = ord(self.map[4]), ord(self.map[5])
+        if elfclass not in (1, 2) or elfdata not in (1, 2):
+            raise ValueError("Unknown ELF class or byte order: %s"%self.path)
+        self.is64 = elfclass == 2
+        self.endian = '<' if elfdata == 1 else '>'
+
+        if self.is64:
+            phoff, = self._unpack('Q', 32)
+            phentsize, phnum = self._unpack('HH', 54)
+        else:
+            phoff, = self._unpack('I', 28)
+            phentsize, phnum = self._unpack('HH', 42)
+
+        self.segments = []
+        for i in range(phnum):
+            if self.is64:
+                ptype, _, offset, vaddr, _, filesz = self._unpack('IIQQQQ', phoff + i*phentsize)
+            else:
+                ptype, offset, vaddr, _, filesz = self._unpack('IIIII', phoff + i*phentsize)
+            self.segments.append(Segment(ptype, offset, vaddr, filesz))
+
+        # Dynamic entries as [tag, value, file offset of the entry]
+        self.dynamic = []
+        for seg in self.segments:
+            if seg.type != PT_DYNAMIC:
+                continue
+            fmt, size = ('qQ', 16) if self.is64 else ('iI', 8)
+            for offset in range(seg.offset, seg.offset + seg.filesz - size + 1, size):
+                tag, val = self._unpack(fmt, offset)
+                if tag == DT_NULL:
+                    break
+                self.dynamic.append((tag, val, offset))
+
+        self.strtab = None
+        for tag, val, _ in self.dynamic:
+            if tag == DT_STRTAB:
+                self.strtab = self.vaddr_to_offset(val)
+
+    def vaddr_to_offset(self, vaddr):
+        for seg in self.segments:
+            if seg.type == PT_LOAD and seg.vaddr <= vaddr < seg.vaddr + seg.filesz:
+                return vaddr - seg.vaddr + seg.offset
+        raise ValueError("Address 0x%x is not mapped from the file: %s"%(vaddr, self.path))
+
+    def string(self, index):
+        """Read a NUL terminated string from the dynamic string table."""
+        start = self.strtab + index
+        return self.map[start:self.map.find('\0', start)]
+
+    def build_id(self):
+        """The GNU build-id as hex, or None."""
+        for seg in self.segments:
+            if seg.type != PT_NOTE:
+                continue
+            p, end = seg.offset, seg.offset + seg.filesz
+            while p + 12 <= end:
+                namesz, descsz, ntype = self._unpack('III', p)
+                name = p + 12
+                desc = name + ((namesz + 3) & ~3)
+                if ntype == NT_GNU_BUILD_ID and self.map[name:name+namesz].rstrip('\0') == 'GNU':
+                    return self.map[desc:desc+descsz].encode('hex')
+                p = desc + ((descsz + 3) & ~3)
+        return None
+
+    def sections(self):
+        """Section names, from the section headers."""
+        if self.is64:
+            shoff, = self._unpack('Q', 40)
+            shentsize, shnum, shstrndx = self._unpack('HHH', 58)
+            fmt = 'IIQQQ'
+        else:
+            shoff, = self._unpack('I', 32)
+            shentsize, shnum, shstrndx = self._unpack('HHH', 46)
+            fmt = 'IIIII'
+        if not shoff or shstrndx >= shnum:
+            return []
+        headers = [self._unpack(fmt, shoff + i*shentsize) for i in range(shnum)]
+        strtab = headers[shstrndx][4]
+        return [self.map[strtab+h[0]:self.map.find('\0', strtab+h[0])] for h in headers]
+
+    def needed(self):
+        """The DT_NEEDED library names."""
+        if self.strtab is None:
+            return []
+        return [self.string(val) for tag, val, _ in self.dynamic if tag == DT_NEEDED]
+
+    def _rpath_entry(self):
+        for tag, val, _ in self.dynamic:
+            if tag in (DT_RPATH, DT_RUNPATH):
+                return tag, val
+        return None
+
+    def rpath(self):
+        """The DT_RUNPATH or DT_RPATH string, or None."""
+        entry = self._rpath_entry()
+        if entry is None:
+            return None
+        return self.string(entry[1])
+
+    def set_rpath(self, rpath):
+        """Overwrite the existing DT_RPATH/DT_RUNPATH string in place.
+
+        Returns False, without changing the file, if there is no rpath entry
+        or the new string does not fit in the old one; the dynamic string
+        table has to grow then, which is left to patchelf.
+        """
+        entry = self._rpath_entry()
+        if entry is None:
+            return False
+        tag, val = entry
+        old = self.string(val)
+        if len(rpath) > len(old):
+            return False
+        # The linker may point other entries into the tail of our string.
+        for t, v, _ in self.dynamic:
+            if t in (DT_NEEDED, DT_SONAME, DT_RPATH, DT_RUNPATH) and val < v <= val + len(old):
+                return False
+        start = self.strtab + val
+        self.map[start:start+len(old)+1] = rpath + '\0'*(len(old)-len(rpath)+1)
+        self.map.flush()
+        return True
+
+##### Mach-O #####
+
+MH_MAGIC = 0xfeedface
+MH_MAGIC_64 = 0xfeedfacf
+FAT_MAGIC_32 = 0xcafebabe
+FAT_MAGIC_64 = 0xcafebabf
+
+LC_SEGMENT = 0x1
+LC_LOAD_DYLIB = 0xc
+LC_ID_DYLIB = 0xd
+LC_SEGMENT_64 = 0x19
+LC_LOAD_WEAK_DYLIB = 0x80000018
+LC_RPATH = 0x8000001c
+LC_UUID = 0x1b
+LC_REEXPORT_DYLIB = 0x8000001f
+LC_LOAD_UPWARD_DYLIB = 0x80000023
+LC_LOAD_DYLIBS = (LC_LOAD_DYLIB, LC_LOAD_WEAK_DYLIB, LC_REEXPORT_DYLIB, LC_LOAD_UPWARD_DYLIB)
+
+# A load command carrying a path string: (cmd, file offset of the command, cmdsize, file offset of the string)
+LoadCommand = collections.namedtuple('LoadCommand', ['cmd', 'offset', 'size', 'stroffset'])
+
+class MachOSlice(object):
+    """Load commands of one architecture in a thin or fat Mach-O file."""
+
+    def __init__(self, macho, offset):
+        self.macho = macho
+        self.offset = offset
+        buf = macho.map
+        magic, = struct.unpack_from('<I', buf, offset)
+        if magic in (MH_MAGIC, MH_MAGIC_64):
+            self.endian = '<'
+        else:
+            self.endian = '>'
+            magic, = struct.unpack_from('>I', buf, offset)
+            if magic not in (MH_MAGIC, MH_MAGIC_64):
+                raise ValueError("Not a Mach-O file: %s"%macho.path)
+        self.is64 = magic == MH_MAGIC_64
+        self.ncmds, self.sizeofcmds = struct.unpack_from(self.endian+'II', buf, offset+16)
+        self.cmds_start = offset + (32 if self.is64 else 28)
+
+        # Headers can grow into the gap up to the first section contents.
+        self.limit = None
+        self.uuid = None
+        self.commands = []
+        p = self.cmds_start
+        for i in range(self.ncmds):
+            cmd, cmdsize = struct.unpack_from(self.endian+'II', buf, p)
+            if cmd == LC_UUID:
+                self.uuid = buf[p+8:p+24].encode('hex')
+            elif cmd in (LC_ID_DYLIB, LC_RPATH) + LC_LOAD_DYLIBS:
+                stroff, = struct.unpack_from(self.endian+'I', buf, p+8)
+                self.commands.append(LoadCommand(cmd, p, cmdsize, p+stroff))
+            elif cmd in (LC_SEGMENT, LC_SEGMENT_64):
+                self._segment(p, cmd == LC_SEGMENT_64)
+            p += cmdsize
+
+    def _segment(self, p, is64):
+        if is64:
+            nsects, = struct.unpack_from(self.endian+'I', self.macho.map, p+64)
+            sect, sectsize, offpos = p+72, 80, 48
+        else:
+            nsects, = struct.unpack_from(self.endian+'I', self.macho.map, p+48)
+            sect, sectsize, offpos = p+56, 68, 40
+        for i in range(nsects):
+            off, = struct.unpack_from(self.endian+'I', self.macho.map, sect + i*sectsize + offpos)
+            if off and (self.limit is None or self.offset + off < self.limit):
+                self.limit = self.offset + off
+
+    def string(self, lc):
+        end = self.macho.map.find('\0', lc.stroffset, lc.offset + lc.size)
+        if end < 0:
+            end = lc.offset + lc.size
+        return self.macho.map[lc.stroffset:end]
+
+    def find(self, *cmds):
+        return [lc for lc in self.commands if lc.cmd in cmds]
+
+    def fits(self, lc, value):
+        return len(value) + 1 <= lc.offset + lc.size - lc.stroffset
+
+    def set_string(self, lc, value):
+        """Overwrite the path of a load command; the caller checks fits() first."""
+        self.macho.map[lc.stroffset:lc.offset+lc.size] = value + '\0'*(lc.offset + lc.size - lc.stroffset - len(value))
+
+    def rpath_size(self, path):
+        align = 8 if self.is64 else 4
+        return (12 + len(path) + 1 + align - 1) // align * align
+
+    def has_room(self, size):
+        end = self.cmds_start + self.sizeofcmds
+        return self.limit is not None and end + size <= self.limit
+
+    def add_rpath(self, path):
+        """Append an LC_RPATH command; the caller checks has_room() first."""
+        size = self.rpath_size(path)
+        end = self.cmds_start + self.sizeofcmds
+        self.macho.map[end:end+size] = struct.pack(self.endian+'III', LC_RPATH, size, 12) + path + '\0'*(size - 12 - len(path))
+        self.ncmds += 1
+        self.sizeofcmds += size
+        struct.pack_into(self.endian+'II', self.macho.map, self.offset+16, self.ncmds, self.sizeofcmds)
+        self.commands.append(LoadCommand(LC_RPATH, end, size, end+12))
+
+class MachOFile(object):
+    """Minimal mmap-backed reader/writer for Mach-O dylib and rpath load commands.
+
+    Thin and fat (universal) files are supported; for fat files the
+    install names are read from the first architecture, and changes
+    are applied to all of them. Use as a context manager.
+    """
 
-def find_ext(ext='', root='.'):
-    """Find files with a particular extension. Include the ".", e.g. ".txt". """
-    found = []
-    for root, dirs, files in os.walk(root):
-        found.extend([os.path.join(root, i) for i in files if i.endswith(ext)])
-    return found
+    def __init__(self, path, write=False):
+        self.path = path
+        self._f = open(path, 'r+b' if write else 'rb')
+        try:
+            self.map = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_WRITE if write else mmap.ACCESS_READ)
+        except Exception:
+            self._f.close()
+            raise
+        try:
+            self.slices = [MachOSlice(self, offset) for offset in self._slice_offsets()]
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.map.close()
+        self._f.close()
+
+    def _slice_offsets(self):
+        magic, = struct.unpack_from('>I', self.map, 0)
+        if magic not in (FAT_MAGIC_32, FAT_MAGIC_64):
+            return [0]
+        nfat, = struct.unpack_from('>I', self.map, 4)
+        offsets = []
+        for i in range(nfat):
+            if magic == FAT_MAGIC_64:
+                offset, = struct.unpack_from('>Q', self.map, 8 + i*32 + 8)
+            else:
+                offset, = struct.unpack_from('>I', self.map, 8 + i*20 + 8)
+            offsets.append(offset)
+        return offsets
+
+    def install_name(self):
+        """The LC_ID_DYLIB install name, or None for executables and bundles."""
+        s = self.slices[0]
+        ids = s.find(LC_ID_DYLIB)
+        return s.string(ids[0]) if ids else None
+
+    def dylibs(self):
+        """The LC_LOAD_DYLIB (and weak/reexport/upward) install names."""
+        s = self.slices[0]
+        return [s.string(lc) for lc in s.find(*LC_LOAD_DYLIBS)]
+
+    def rpaths(self):
+        """The LC_RPATH search paths."""
+        s = self.slices[0]
+        return [s.string(lc) for lc in s.find(LC_RPATH)]
+
+    def rewrite(self, install_name=None, changes=None, rpath=None):
+        """Apply -id/-change/-add_rpath equivalents directly to the headers.
+
+        Nothing is written and False is returned unless every change fits
+        in every architecture; the caller then falls back to install_name_tool.
+        """
+        changes = changes or {}
+        for s in self.slices:
+            for lc in s.find(LC_ID_DYLIB):
+                if install_name and not s.fits(lc, install_name):
+                    return False
+            for lc in s.find(*LC_LOAD_DYLIBS):
+                new = changes.get(s.string(lc))
+                if new and not s.fits(lc, new):
+                    return False
+            if rpath and rpath not in [s.string(lc) for lc in s.find(LC_RPATH)] and not s.has_room(s.rpath_size(rpath)):
+                return False
+        for s in self.slices:
+            for lc in s.find(LC_ID_DYLIB):
+                if install_name:
+                    s.set_string(lc, install_name)
+            for lc in s.find(*LC_LOAD_DYLIBS):
+                new = changes.get(s.string(lc))
+                if new:
+                    s.set_string(lc, new)
+            if rpath and rpath not in [s.string(lc) for lc in s.find(LC_RPATH)]:
+                s.add_rpath(rpath)
+        self.map.flush()
+        return True
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive flock on path, for state shared by the builds of a root."""
+    with open(path, 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def history_db(path):
+    """Connect to the history database. Builds of a matrix share it, so writers wait for each other."""
+    return sqlite3.connect(path, timeout=600)
+
+def record_steps(args, date, steps):
+    """Append step metrics, dicts of step, status, wall, user, sys, maxrss and written, to the history database."""
+    db = history_db(args.history)
+    with db:
+        db.execute("""CREATE TABLE IF NOT EXISTS steps (date TEXT, commit_id TEXT, target TEXT, release TEXT, step TEXT, status TEXT,
+            wall REAL, user REAL, sys REAL, maxrss INTEGER, written INTEGER)""")
+        for m in steps:
+            db.execute("INSERT INTO steps VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                (date, args.commit, args.target_desc, args.release, m['step'], m['status'],
+                 m['wall'], m['user'], m['sys'], m['maxrss'], m['written']))
+    db.close()
+
+@contextlib.contextmanager
+def writable(path):
+    """Temporarily add owner write permission to a file."""
+    mode = os.stat(path).st_mode
+    if not mode & stat.S_IWUSR:
+        os.chmod(path, mode | stat.S_IWUSR)
+    try:
+        yield path
+    finally:
+        if not mode & stat.S_IWUSR:
+            os.chmod(path, mode)
+
+def overlaps(a, b):
+    """True if one path is the same as, or inside, the other."""
+    a, b = a.rstrip(os.sep), b.rstrip(os.sep)
+    return a == b or a.startswith(b + os.sep) or b.startswith(a + os.sep)
+
+# ioctl to clone a file's extents on copy-on-write filesystems (btrfs, XFS)
+FICLONE = 0x40049409
+
+def reflink(src, dst):
+    """Create dst as a copy-on-write clone of src. Raises IOError where unsupported."""
+    with open(src, 'rb') as s:
+        with open(dst, 'wb') as d:
+            try:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            except (IOError, OSError):
+                d.close()
+                os.unlink(dst)
+                raise
+
+def copy_file(src, dst, chunk=1<<20):
+    """Copy file contents in chunks, then mode and times."""
+    with open(src, 'rb') as s:
+        with open(dst, 'wb') as d:
+            shutil.copyfileobj(s, d, chunk)
+    shutil.copystat(src, dst)
+
+def break_link(path):
+    """Give a hardlinked file its own copy before it is modified in place.
+
+    Files in the stage may be hardlinks into extlib/<distname> (see CopyExtlib).
+    Returns True if the link was broken.
+    """
+    if os.lstat(path).st_nlink < 2:
+        return False
+    tmp = path + '.cow'
+    try:
+        reflink(path, tmp)
+        shutil.copystat(path, tmp)
+    except (IOError, OSError):
+        copy_file(path, tmp)
+    os.rename(tmp, path)
+    return True
 
 def mkdirs(path):
     """mkdir -p"""
@@ -72,19 +693,131 @@ def retree(path):
     if not os.path.exists(path):
         os.makedirs(path)  
     
-def cmd(*popenargs, **kwargs):
-    print("Running: {}".format(" ".join(*popenargs)))
+# ru_maxrss is in bytes on OS X, and kilobytes on Linux
+RUSAGE_SCALE = 1 if sys.platform == 'darwin' else 1024
+
+def resource_usage():
+    """Snapshot of this process and its waited-for children.
+
+    Returns a dict of CPU seconds, the peak RSS of this process (bytes;
+    a high-water mark for the whole run) and bytes written to storage.
+    """
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    written = None
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    written = int(line.split()[1])
+    except IOError:
+        pass
+    if written is None:
+        written = (me.ru_oublock + children.ru_oublock) * 512
+    return {
+        'wall': time.time(),
+        'user': me.ru_utime + children.ru_utime,
+        'sys': me.ru_stime + children.ru_stime,
+        'maxrss': me.ru_maxrss * RUSAGE_SCALE,
+        'written': written,
+    }
+
+class StepLog(object):
+    """Compressed log file for the output of one build step.
+
+    Lines are written from several threads; the file is flushed at most
+    once per second, so it can be followed with zcat while the step runs.
+    """
 
+    def __init__(self, path):
+        mkdirs(os.path.dirname(path))
+        self.path = path
+        self._f = gzip.open(path, 'wb')
+        self._lock = threading.Lock()
+        self._flushed = time.time()
+        # Largest peak RSS of the commands run by the step, see run_command()
+        self.maxrss = 0
+
+    def command_rss(self, maxrss):
+        with self._lock:
+            self.maxrss = max(self.maxrss, maxrss)
+
+    def write(self, line):
+        with self._lock:
+            self._f.write(line)
+            if time.time() - self._flushed > 1:
+                self._f.flush()
+                self._flushed = time.time()
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+_steplog = threading.local()
+
+def current_step_log():
+    """The StepLog of the step running in this thread, or None."""
+    return getattr(_steplog, 'current', None)
+
+@contextlib.contextmanager
+def step_log(path):
+    """Send command output in this thread to a new StepLog at path."""
+    steplog = StepLog(path)
+    previous = current_step_log()
+    _steplog.current = steplog
+    try:
+        yield steplog
+    finally:
+        _steplog.current = previous
+        steplog.close()
+
+def run_command(args, echo=False, tail=200, **kwargs):
+    """Run a command, streaming stdout and stderr line by line.
+
+    Each line is written to the current step log and, with echo, to stdout.
+    Only the last `tail` lines are kept in memory. Returns (exitcode, tail).
+    """
     kwargs['stdout'] = subprocess.PIPE
     kwargs['stderr'] = subprocess.PIPE
-    process = subprocess.Popen(*popenargs, **kwargs)
-    # 
-    a, b = process.communicate()
-    exitcode = process.wait()
+    process = subprocess.Popen(args, **kwargs)
+    lines = collections.deque(maxlen=tail)
+    steplog = current_step_log()
+    lock = threading.Lock()
+
+    def pump(pipe):
+        for line in iter(lambda: pipe.readline(65536), ''):
+            with lock:
+                lines.append(line)
+                if steplog:
+                    steplog.write(line)
+                if echo:
+                    sys.stdout.write(line)
+                    sys.stdout.flush()
+        pipe.close()
+
+    if steplog:
+        steplog.write("Running: %s\n"%" ".join(args))
+    readers = [threading.Thread(target=pump, args=(pipe,)) for pipe in (process.stdout, process.stderr)]
+    for t in readers:
+        t.start()
+    for t in readers:
+        t.join()
+    # wait4 gives the peak RSS of this command alone, for the step's metrics.
+    pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    if steplog:
+        steplog.command_rss(usage.ru_maxrss * RUSAGE_SCALE)
+    return process.returncode, list(lines)
+
+def cmd(*popenargs, **kwargs):
+    """Run a command; output is streamed to the step log, and the tail is printed on failure."""
+    print("Running: {}".format(" ".join(*popenargs)))
+
+    exitcode, tail = run_command(*popenargs, **kwargs)
     if exitcode:
         print("WARNING: Command returned non-zero exit code: %s"%" ".join(*popenargs))
-        print a
-        print b
+        sys.stdout.write("".join(tail))
+    return exitcode
 
 def echo(*popenargs, **kwargs):
     print " ".join(popenargs)    
@@ -103,6 +836,644 @@ def check_output(*popenargs, **kwargs):
         raise subprocess.CalledProcessError(retcode, cmd)            
     return output
 
+class Executor(object):
+    """Bounded-concurrency runner for per-file work within a Builder step.
+
+    Each submit() call queues the tasks for one key (usually a filename);
+    tasks for a key run in order on a single worker, and their output is
+    printed together, in submission order, by join(). A task is either a
+    command (list of arguments) or a callable, which may in turn run
+    commands with call(). Failed commands and exceptions are collected
+    into failures as (key, message) pairs.
+    """
+
+    def __init__(self, threads):
+        self.threads = max(1, int(threads))
+        self.pool = ThreadPool(self.threads)
+        self.pending = []
+        self.failures = []
+        self._local = threading.local()
+
+    def submit(self, key, *tasks):
+        self.pending.append(self.pool.apply_async(self._run, (key, tasks, current_step_log())))
+
+    def _run(self, key, tasks, steplog):
+        _steplog.current = steplog
+        self._local.output = output = []
+        self._local.failed = failed = []
+        results = []
+        for task in tasks:
+            try:
+                if callable(task):
+                    results.append(task())
+                else:
+                    results.append(self.call(task))
+            except Exception, e:
+                failed.append("%s: %s"%(e.__class__.__name__, e))
+            if failed:
+                break
+        self._local.output = self._local.failed = None
+        _steplog.current = None
+        return key, results, output, failed
+
+    def call(self, args, **kwargs):
+        """Run a command from a task, keeping its output with the task's key. Returns the exit code."""
+        output = getattr(self._local, 'output', None)
+        if output is None:
+            return cmd(args, **kwargs)
+        output.append("Running: %s"%" ".join(args))
+        exitcode, tail = run_command(args, **kwargs)
+        if exitcode:
+            output.append("WARNING: Command returned non-zero exit code: %s"%" ".join(args))
+            output.append("".join(tail))
+            self._local.failed.append("%s returned %s"%(" ".join(args), exitcode))
+        return exitcode
+
+    def join(self):
+        """Wait for all tasks. Returns [(key, results)] in submission order."""
+        self.pool.close()
+        done = []
+        for pending in self.pending:
+            key, results, output, failed = pending.get()
+            for line in output:
+                print(line)
+            self.failures.extend((key, i) for i in failed)
+            done.append((key, results))
+        self.pool.join()
+        self.pending = []
+        return done
+
+##### Packaging #####
+
+def python_version(python):
+    """(major, minor) of a Python interpreter, or None if it does not run."""
+    try:
+        return tuple(int(i) for i in check_output([python, '-c', 'import sys; print("%d %d"%sys.version_info[:2])']).split())
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def source_date_epoch(args):
+    """Timestamp used for every file in packaged images, so they are reproducible.
+
+    SOURCE_DATE_EPOCH if set, otherwise the commit time of the checkout,
+    otherwise midnight UTC today.
+    """
+    if os.getenv('SOURCE_DATE_EPOCH'):
+        return int(os.getenv('SOURCE_DATE_EPOCH'))
+    try:
+        return int(check_output(['git', 'log', '-1', '--format=%ct'], cwd=args.cwd_co_distname).strip())
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return int(time.time()) // 86400 * 86400
+
+# Timestamp of the files in the --layers directories (see TarballPackage).
+# It does not change with the commit, so neither do those layers, nor the
+# .pyc files in them, while their contents stay the same.
+LAYER_EPOCH = 946684800 # 2000-01-01
+
+def layer_dirs(args):
+    """The --layers directories of the stage that are packaged as layers of their own, sorted."""
+    dirs = sorted(set(i.strip('/') for i in (args.layers or '').split(',') if i.strip('/')))
+    return [i for i in dirs if os.path.isdir(os.path.join(args.cwd_rpath, i)) and not os.path.islink(os.path.join(args.cwd_rpath, i))]
+
+class GzipSink(object):
+    """Write a gzip file compressed in parallel as independent gzip members.
+
+    The stream is cut into blocks of about blocksize bytes, at tar entry
+    boundaries where possible, and each block is compressed by a worker.
+    Concatenated members are a valid gzip file for gunzip and tar.
+    """
+
+    def __init__(self, fileobj, threads, level=6, blocksize=4<<20):
+        self.out = fileobj
+        self.threads = max(1, int(threads))
+        self.pool = ThreadPool(self.threads)
+        self.level = level
+        self.blocksize = blocksize
+        self.buf = []
+        self.size = 0
+        self.large = False
+        self.pending = collections.deque()
+
+    def _compress(self, data):
+        z = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return z.compress(data) + z.flush()
+
+    def cut(self):
+        if self.size:
+            self.pending.append(self.pool.apply_async(self._compress, ("".join(self.buf),)))
+            self.buf, self.size = [], 0
+        # Bound the memory used by blocks waiting to be written.
+        while len(self.pending) > 2 * self.threads:
+            self.out.write(self.pending.popleft().get())
+
+    def boundary(self, size):
+        """Called before each tar entry with its data size."""
+        # Large entries start a block of their own, so their blocks do not
+        # depend on what comes before them in the archive.
+        self.large = size >= self.blocksize
+        if self.size >= self.blocksize or (self.size and self.large):
+            self.cut()
+
+    def write(self, data):
+        self.buf.append(data)
+        self.size += len(data)
+        if self.large and self.size >= self.blocksize:
+            self.cut()
+
+    def close(self):
+        self.cut()
+        while self.pending:
+            self.out.write(self.pending.popleft().get())
+        self.pool.close()
+        self.pool.join()
+        self.out.close()
+
+class ProcessSink(object):
+    """Write through an external compressor such as zstd or xz."""
+
+    def __init__(self, fileobj, args):
+        self.args = args
+        self.out = fileobj
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=fileobj)
+
+    def boundary(self, size):
+        pass
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        self.process.stdin.close()
+        exitcode = self.process.wait()
+        self.out.close()
+        if exitcode:
+            raise Exception, "%s returned %s"%(" ".join(self.args), exitcode)
+
+IMAGE_FORMATS = ('.tar.gz', '.tar.zst', '.tar.xz')
+
+def compressor(image, threads):
+    """A sink writing image.tmp, chosen by the .tar.gz, .tar.zst or .tar.xz suffix of image."""
+    out = open(image + '.tmp', 'wb')
+    if image.endswith('.tar.gz'):
+        return GzipSink(out, threads)
+    elif image.endswith('.tar.zst'):
+        return ProcessSink(out, ['zstd', '-q', '-T%s'%threads, '-c'])
+    else:
+        return ProcessSink(out, ['xz', '-T%s'%threads, '-c'])
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def hash_files(paths, db, threads=4):
+    """sha256 of each file, reusing the hashes in the filehashes table while size and mtime match."""
+    db.execute("CREATE TABLE IF NOT EXISTS filehashes (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha256 TEXT)")
+    known = dict((p, (s, m, h)) for p, s, m, h in db.execute("SELECT path, size, mtime, sha256 FROM filehashes"))
+    hashes, stale = {}, []
+    for path in paths:
+        st = os.lstat(path)
+        if known.get(path, (None, None))[:2] == (st.st_size, st.st_mtime):
+            hashes[path] = known[path][2]
+        else:
+            stale.append((path, st))
+    pool = ThreadPool(threads)
+    try:
+        digests = pool.map(sha256_file, [path for path, st in stale])
+    finally:
+        pool.close()
+    with db:
+        for (path, st), digest in zip(stale, digests):
+            hashes[path] = digest
+            db.execute("INSERT OR REPLACE INTO filehashes VALUES (?,?,?,?)", (path, st.st_size, st.st_mtime, digest))
+    return hashes
+
+def tar_entries(root, arcname, mtime, exclude=()):
+    """Yield (TarInfo, path) for root and everything below it, except the paths in exclude.
+
+    Entries are sorted, symlinks are not followed, and owner and
+    mtime are normalized so the same tree always gives the same archive.
+    """
+    seen = {}
+    stack = [(root, arcname)]
+    while stack:
+        path, name = stack.pop()
+        st = os.lstat(path)
+        info = tarfile.TarInfo(name)
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.mtime = mtime
+        info.uid = info.gid = 0
+        info.uname = info.gname = 'root'
+        if stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+            stack.extend((os.path.join(path, i), name+'/'+i) for i in sorted(os.listdir(path), reverse=True)
+                         if os.path.join(path, i) not in exclude)
+        elif stat.S_ISLNK(st.st_mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = os.readlink(path)
+        elif stat.S_ISREG(st.st_mode):
+            # Files hardlinked within the tree are stored once.
+            if st.st_nlink > 1 and (st.st_dev, st.st_ino) in seen:
+                info.type = tarfile.LNKTYPE
+                info.linkname = seen[(st.st_dev, st.st_ino)]
+            else:
+                seen[(st.st_dev, st.st_ino)] = name
+                info.size = st.st_size
+        else:
+            continue
+        yield info, path
+
+def write_tar(sink, root, arcname, mtime, eof=True, exclude=()):
+    """Stream a deterministic tar of root into a sink in a single pass. Returns the bytes written."""
+    written = 0
+    for info, path in tar_entries(root, arcname, mtime, exclude):
+        sink.boundary(info.size)
+        header = info.tobuf(tarfile.GNU_FORMAT)
+        sink.write(header)
+        written += len(header)
+        if info.size:
+            with open(path, 'rb') as f:
+                remaining = info.size
+                while remaining:
+                    data = f.read(min(remaining, 1<<20))
+                    if not data:
+                        raise IOError("File changed while packaging: %s"%path)
+                    sink.write(data)
+                    remaining -= len(data)
+            pad = -info.size % tarfile.BLOCKSIZE
+            sink.write(tarfile.NUL * pad)
+            written += info.size + pad
+    if eof:
+        # End of archive marker, padded to a full record like tar(1).
+        end = 2 * tarfile.BLOCKSIZE
+        end += -(written + end) % tarfile.RECORDSIZE
+        sink.boundary(0)
+        sink.write(tarfile.NUL * end)
+        written += end
+    return written
+
+class Fanout(object):
+    """Send one stream to several sinks."""
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def boundary(self, size):
+        for s in self.sinks:
+            s.boundary(size)
+
+    def write(self, data):
+        for s in self.sinks:
+            s.write(data)
+
+    def close(self):
+        for s in self.sinks:
+            s.close()
+
+def write_images(root, arcname, images, threads, mtime):
+    """Write root as tarballs in every format in images, reading the tree once.
+
+    Each image is written to a temporary name and renamed when complete.
+    """
+    for i in images:
+        if not i.endswith(IMAGE_FORMATS):
+            raise ValueError("Unknown image format: %s"%i)
+    sinks = Fanout([compressor(i, threads) for i in images])
+    try:
+        try:
+            size = write_tar(sinks, root, arcname, mtime)
+        finally:
+            sinks.close()
+    except:
+        for i in images:
+            if os.path.exists(i + '.tmp'):
+                os.unlink(i + '.tmp')
+        raise
+    for i in images:
+        os.rename(i + '.tmp', i)
+        print("%s: %.0f MB from %.0f MB"%(os.path.basename(i), os.path.getsize(i)/2.0**20, size/2.0**20))
+
+# Upload: images are split into content-defined chunks, and only the
+# chunks the destination does not already have are sent. The destination
+# keeps them in .chunks/ for the next upload, and puts the image together
+# from its manifest. Builds of several targets upload into the same
+# .chunks/, so an upload never removes chunks; the prune_uploads command
+# removes the unreferenced ones once they are --upload-grace-days old,
+# which an upload in progress never is.
+
+CHUNK_ANCHOR = '\xe5\x9b'
+
+def chunks(path, minsize=256<<10, maxsize=4<<20):
+    """Yield (offset, size, sha256) for the chunks of a file.
+
+    A chunk ends at the first CHUNK_ANCHOR after minsize bytes, or at
+    maxsize. Boundaries depend only on nearby content, so an edit to an
+    image only changes the chunks around it.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = 0
+            while offset < size:
+                end = data.find(CHUNK_ANCHOR, offset + minsize, offset + maxsize)
+                end = min(end + len(CHUNK_ANCHOR) if end >= 0 else offset + maxsize, size)
+                yield offset, end - offset, hashlib.sha256(data[offset:end]).hexdigest()
+                offset = end
+        finally:
+            data.close()
+
+class LocalTransport(object):
+    """Upload into a local directory; a stand-in for the upload host."""
+
+    def __init__(self, dest):
+        self.dest = dest
+        self.chunkdir = os.path.join(dest, '.chunks')
+        mkdirs(self.chunkdir)
+
+    def __str__(self):
+        return self.dest
+
+    def chunks(self):
+        """Chunks already at the destination."""
+        return set(i for i in os.listdir(self.chunkdir) if len(i) == 64)
+
+    def put(self, name, data):
+        """Store one chunk; a chunk appears under its name only when complete."""
+        path = os.path.join(self.chunkdir, name)
+        with open(path + '.part', 'wb') as f:
+            f.write(data)
+        os.rename(path + '.part', path)
+
+    def verify(self, names):
+        """Remove the chunks whose content does not match their name; returns them."""
+        bad = []
+        for name in names:
+            path = os.path.join(self.chunkdir, name)
+            with open(path, 'rb') as f:
+                if hashlib.sha256(f.read()).hexdigest() != name:
+                    bad.append(name)
+                    os.unlink(path)
+        return bad
+
+    def assemble(self, filename, manifest):
+        """Concatenate the chunks of manifest into filename; returns its sha256."""
+        path = os.path.join(self.dest, filename)
+        h = hashlib.sha256()
+        with open(path + '.tmp', 'wb') as out:
+            for name in manifest['chunks']:
+                with open(os.path.join(self.chunkdir, name), 'rb') as f:
+                    data = f.read()
+                h.update(data)
+                out.write(data)
+        if h.hexdigest() == manifest['sha256']:
+            with file_lock(os.path.join(self.chunkdir, '.lock')):
+                with open(os.path.join(self.chunkdir, filename + '.manifest'), 'w') as f:
+                    json.dump(manifest, f)
+                os.rename(path + '.tmp', path)
+        else:
+            os.unlink(path + '.tmp')
+        return h.hexdigest()
+
+    def prune(self, grace):
+        """Remove the chunks that no manifest refers to and that are older than grace seconds; returns how many."""
+        removed = 0
+        with file_lock(os.path.join(self.chunkdir, '.lock')):
+            keep = set()
+            for i in glob.glob(os.path.join(self.chunkdir, '*.manifest')):
+                with open(i) as f:
+                    keep.update(json.load(f)['chunks'])
+            cutoff = time.time() - grace
+            for name in self.chunks() - keep:
+                path = os.path.join(self.chunkdir, name)
+                if os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+                    removed += 1
+        return removed
+
+class SshTransport(object):
+    """Upload to user@host:dest over one multiplexed ssh connection."""
+
+    def __init__(self, user, host, dest):
+        self.dest = dest
+        self.chunkdir = os.path.join(dest, '.chunks')
+        self.ssh = ['ssh', '-o', 'BatchMode=yes', '-o', 'ControlMaster=auto', '-o', 'ControlPersist=60',
+            '-o', 'ControlPath=%s/ssh-%%r@%%h:%%p'%tempfile.gettempdir(), '%s@%s'%(user, host)]
+        self.target = '%s@%s:%s'%(user, host, dest)
+        self.remote('mkdir -p %s'%pipes.quote(self.chunkdir))
+
+    def __str__(self):
+        return self.target
+
+    def remote(self, command, data=None):
+        """Run a shell command on the host; returns its output."""
+        p = subprocess.Popen(self.ssh + [command], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out, unused = p.communicate(data)
+        if p.returncode:
+            raise Exception, "ssh %s: %s returned %s"%(self.target, command, p.returncode)
+        return out
+
+    def chunks(self):
+        out = self.remote('ls %s'%pipes.quote(self.chunkdir))
+        return set(i for i in out.split() if len(i) == 64)
+
+    def put(self, name, data):
+        path = pipes.quote(os.path.join(self.chunkdir, name))
+        self.remote('cat > %s.part && mv %s.part %s'%(path, path, path), data)
+
+    def verify(self, names):
+        out = self.remote('cd %s && xargs sha256sum'%pipes.quote(self.chunkdir), "".join(i+'\n' for i in names))
+        bad = [name for digest, name in (i.split() for i in out.splitlines()) if digest != name]
+        if bad:
+            self.remote('cd %s && xargs rm -f'%pipes.quote(self.chunkdir), "".join(i+'\n' for i in bad))
+        return bad
+
+    def assemble(self, filename, manifest):
+        path = pipes.quote('../' + filename)
+        script = ('cd {chunks} && xargs cat > {path}.tmp && set -- $(sha256sum {path}.tmp) && echo $1 && '
+            'if [ $1 = {sha256} ]; then cat > {name}.manifest <<"EOF" && mv {path}.tmp {path}; else rm -f {path}.tmp; fi\n{manifest}\nEOF\n').format(
+            chunks=pipes.quote(self.chunkdir), path=path, name=pipes.quote(filename), sha256=manifest['sha256'], manifest=json.dumps(manifest))
+        return self.remote(script, "".join(i+'\n' for i in manifest['chunks'])).split()[0]
+
+    def prune(self, grace):
+        script = ('cat *.manifest | tr -c "0-9a-f" "\\n" | grep -E "^[0-9a-f]{64}$" | sort -u > .keep && '
+            'find . -maxdepth 1 -type f -mmin +%d | sed "s|^\\./||" | grep -E "^[0-9a-f]{64}$" | sort | comm -23 - .keep > .prune; '
+            'xargs rm -f < .prune; wc -l < .prune; rm -f .keep .prune'%(grace // 60))
+        return int(self.remote('cd %s && flock .lock sh -c %s'%(pipes.quote(self.chunkdir), pipes.quote(script))))
+
+def upload_transport(args):
+    """The transport for the upload steps: --upload-dir, or scp host and directory."""
+    if args.upload_dir:
+        return LocalTransport(args.upload_dir)
+    return SshTransport(args.scpuser, args.scphost, args.scpdest)
+
+def upload(path, transport, threads=4, retries=3):
+    """Send path to the transport, skipping the chunks it already has.
+
+    An interrupted upload resumes from the chunks that arrived. The
+    image is only put in place when its sha256 matches; otherwise the
+    chunks are checked, and the bad ones sent again.
+    """
+    filename = os.path.basename(path)
+    parts = list(chunks(path))
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), ''):
+            h.update(chunk)
+    manifest = {'size': os.path.getsize(path), 'sha256': h.hexdigest(), 'chunks': [c for o, s, c in parts]}
+
+    def put(part):
+        offset, size, name = part
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(size)
+        for attempt in range(retries):
+            try:
+                transport.put(name, data)
+                break
+            except Exception, e:
+                if attempt == retries - 1:
+                    raise
+                print("Retrying chunk %s of %s: %s"%(name[:12], filename, e))
+
+    sent, count = 0, 0
+    for attempt in range(retries):
+        have = transport.chunks()
+        missing = dict((c, (o, s, c)) for o, s, c in parts if c not in have)
+        pool = ThreadPool(threads)
+        try:
+            pool.map(put, missing.values())
+        finally:
+            pool.close()
+        sent += sum(s for o, s, c in missing.values())
+        count += len(missing)
+        digest = transport.assemble(filename, manifest)
+        if digest == manifest['sha256']:
+            break
+        bad = transport.verify(sorted(set(manifest['chunks'])))
+        print("%s: sha256 mismatch at %s, %s bad chunks"%(filename, transport, len(bad)))
+    else:
+        raise Exception, "Upload of %s to %s failed verification"%(filename, transport)
+    print("%s: sent %.1f MB of %.1f MB (%.0f%%) in %s of %s chunks, sha256 %s"%(filename, sent/2.0**20,
+        manifest['size']/2.0**20, 100.0*sent/max(manifest['size'], 1), count, len(parts), manifest['sha256'][:12]))
+    return sent
+
+# Image store: every packaged image is kept as a manifest of chunks in
+# <root>/store, so consecutive nightlies share most of their storage.
+
+IMAGE_SUFFIXES = IMAGE_FORMATS + ('.dmg',)
+
+class ImageStore(object):
+    """Content-addressed, deduplicating store of images.
+
+    chunks/ab/<sha256> holds each distinct chunk once, and
+    manifests/<image>/<date>-<commit>.json lists the chunks of one
+    stored image. Adding and collecting garbage take an exclusive lock,
+    so a collection never removes the chunks of an image being added.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.chunkdir = os.path.join(root, 'chunks')
+        self.manifestdir = os.path.join(root, 'manifests')
+        mkdirs(self.chunkdir)
+        mkdirs(self.manifestdir)
+
+    @contextlib.contextmanager
+    def lock(self):
+        with file_lock(os.path.join(self.root, 'lock')):
+            yield
+
+    def chunk_path(self, name):
+        return os.path.join(self.chunkdir, name[:2], name)
+
+    def add(self, path, commit, release):
+        """Store an image; returns its manifest and the bytes that were new to the store."""
+        now = datetime.datetime.utcnow()
+        manifest = {'image': os.path.basename(path), 'commit': commit, 'release': release,
+            'date': now.isoformat(), 'size': os.path.getsize(path), 'chunks': []}
+        h = hashlib.sha256()
+        added = 0
+        with self.lock(), open(path, 'rb') as f:
+            for offset, size, name in chunks(path):
+                f.seek(offset)
+                data = f.read(size)
+                h.update(data)
+                manifest['chunks'].append((name, size))
+                target = self.chunk_path(name)
+                if not os.path.exists(target):
+                    mkdirs(os.path.dirname(target))
+                    with open(target + '.tmp', 'wb') as out:
+                        out.write(data)
+                    os.rename(target + '.tmp', target)
+                    added += size
+            manifest['sha256'] = h.hexdigest()
+            mkdirs(os.path.join(self.manifestdir, manifest['image']))
+            name = os.path.join(self.manifestdir, manifest['image'], '%s-%s.json'%(now.strftime('%Y%m%dT%H%M%S'), commit))
+            with open(name + '.tmp', 'w') as out:
+                json.dump(manifest, out)
+            os.rename(name + '.tmp', name)
+        return manifest, added
+
+    def manifests(self, image=None):
+        """Stored manifests, oldest first, as (path, manifest)."""
+        found = []
+        for path in sorted(glob.glob(os.path.join(self.manifestdir, image or '*', '*.json'))):
+            with open(path) as f:
+                found.append((path, json.load(f)))
+        return found
+
+    def find(self, image, commit=None):
+        """The newest manifest of image, from commit if given."""
+        found = [m for path, m in self.manifests(image) if not commit or m['commit'].startswith(commit)]
+        return found[-1] if found else None
+
+    def restore(self, manifest, out):
+        """Write a stored image to the file object out, one chunk at a time, checking its sha256."""
+        h = hashlib.sha256()
+        for name, size in manifest['chunks']:
+            with open(self.chunk_path(name), 'rb') as f:
+                data = f.read()
+            h.update(data)
+            out.write(data)
+        if h.hexdigest() != manifest['sha256']:
+            raise IOError("Stored image is corrupt: %s from %s"%(manifest['image'], manifest['commit']))
+
+    def retain(self, nightlies, release='daily'):
+        """Keep the newest nightlies manifests of each nightly image; images of other releases are all kept."""
+        byimage = collections.defaultdict(list)
+        for path, m in self.manifests():
+            if m['release'] == release:
+                byimage[m['image']].append(path)
+        removed = 0
+        for image, paths in byimage.items():
+            for path in paths[:max(0, len(paths) - nightlies)]:
+                os.unlink(path)
+                removed += 1
+        return removed
+
+    def gc(self):
+        """Remove the chunks that no manifest refers to; returns the bytes freed."""
+        freed = 0
+        with self.lock():
+            keep = set()
+            for path, m in self.manifests():
+                keep.update(name for name, size in m['chunks'])
+            for path in glob.glob(os.path.join(self.chunkdir, '*', '*')):
+                if os.path.basename(path) not in keep:
+                    freed += os.path.getsize(path)
+                    os.unlink(path)
+        return freed
+
+    def usage(self):
+        """Bytes used by chunks, and bytes the stored images would take in full."""
+        used = sum(os.path.getsize(i) for i in glob.glob(os.path.join(self.chunkdir, '*', '*')))
+        return used, sum(m['size'] for path, m in self.manifests())
+
 ##### Targets #####
 
 class Target(object):
@@ -130,11 +1501,25 @@ class Target(object):
 
     # eman2.cshrc
     cshrc = None
+
+    # Directories of the install that the rc files put on PYTHONPATH, for
+    # site/ (see GenerateSite); None when no rc file of this target uses site/.
+    pythonpath = None
+
+    # Commands that only produce the image, and that a ledger hit skips.
+    producing = ('checkout', 'build', 'install', 'package')
+
+    # Options that change the image, and so are part of the ledger fingerprint.
+    fingerprint_args = ('repository', 'release', 'target_desc', 'python', 'installtxt', 'bashrc', 'cshrc', 'cvstag', 'formats', 'prune', 'prune_keep', 'strip', 'compile', 'import_index', 'layers', 'pythonpath')
     
     def __init__(self, args):
         args = self.update_args(args)
         args = self.update_cwds(args)
         self.args = args
+        # Resource usage of each Builder run, see measure()
+        self.metrics = []
+        # Steps that finished with failures; their output is not recorded in the ledger.
+        self.incomplete = []
         # print "Updated args:"
         # for k,v in sorted(vars(args).items()): print k, v, "\n\n"
 
@@ -145,6 +1530,7 @@ class Target(object):
         args.installtxt = self.installtxt
         args.bashrc = self.bashrc
         args.cshrc = self.cshrc
+        args.pythonpath = self.pythonpath
         args.target_desc = self.target_desc
         return args
 
@@ -154,6 +1540,7 @@ class Target(object):
         # calls in the main code, because each one is a chance for an error.        
         args.cwd_co           = os.path.join(args.root, 'co')
         args.cwd_co_distname  = os.path.join(args.root, 'co',      args.distname)
+        args.cwd_mirror       = os.path.join(args.root, 'co',      args.repository+'.git')
         args.cwd_extlib       = os.path.join(args.root, 'extlib',  args.distname)
         args.cwd_build        = os.path.join(args.root, 'build',   args.distname)
         args.cwd_images       = os.path.join(args.root, 'images',  args.distname)
@@ -161,6 +1548,11 @@ class Target(object):
         args.cwd_rpath        = os.path.join(args.root, 'stage',   args.distname, args.repository.upper())
         args.cwd_rpath_extlib = os.path.join(args.cwd_rpath, 'extlib')
         args.cwd_rpath_lib    = os.path.join(args.cwd_rpath, 'lib')           
+        args.cwd_logs         = os.path.join(args.root, 'logs',    args.distname)
+        args.history          = os.path.join(args.root, 'history.sqlite')
+        args.cwd_store        = os.path.join(args.root, 'store')
+        args.cwd_debug        = os.path.join(args.root, 'debug',   args.distname)
+        args.cwd_layers       = os.path.join(args.root, 'layers',  args.distname)
 
         # OS X links using absolute pathnames; update these to @rpath macro.
         # This dictionary contains regex sub keys/values
@@ -178,16 +1570,293 @@ class Target(object):
         }
         return args
         
+    def _step(self, builder):
+        # Command output goes to logs/<distname>/<Builder>.log.gz
+        name = builder.__class__.__name__
+        with step_log(os.path.join(self.args.cwd_logs, name+'.log.gz')), self.measure(name):
+            builder.run()
+        if builder.failures:
+            self.incomplete.append(name)
+        # Steps that add, remove or replace files make the shared index stale.
+        if builder.writes_stage:
+            stage_index(self.args.cwd_rpath).invalidate()
+
+    def schedule(self, builders):
+        """Dependencies between Builders, from the paths they declare.
+
+        A step depends on every earlier step in the list that writes
+        a path it reads or writes, or that reads a path it writes.
+        Returns a list with the set of dependencies of each step.
+        """
+        deps = []
+        for i, b in enumerate(builders):
+            deps.append(set())
+            for j, a in enumerate(builders[:i]):
+                if any(overlaps(x, y) for x in a.writes() for y in b.reads() + b.writes()) or \
+                   any(overlaps(x, y) for x in b.writes() for y in a.reads()):
+                    deps[i].add(j)
+        return deps
+
+    def print_schedule(self, builders, deps):
+        """Print the steps that can run together, and the critical path."""
+        # Estimate step durations from the last successful build.
+        estimates = {}
+        if os.path.exists(self.args.history):
+            db = history_db(self.args.history)
+            try:
+                for step, wall in db.execute("SELECT step, wall FROM steps WHERE target=? AND release=? AND status='ok' ORDER BY date",
+                        (self.args.target_desc, self.args.release)):
+                    estimates[step] = wall
+            except sqlite3.Error:
+                pass
+            db.close()
+        names = [b.__class__.__name__ for b in builders]
+        level, finish, prev = [], [], []
+        for i in range(len(builders)):
+            level.append(1 + max([level[j] for j in deps[i]] or [0]))
+            start = max([finish[j] for j in deps[i]] or [0])
+            prev.append(max(deps[i], key=lambda j: finish[j]) if deps[i] else None)
+            # Without history, the critical path is the longest chain of steps.
+            finish.append(start + estimates.get(names[i], 0 if estimates else 1))
+        print("Schedule:")
+        for l in range(1, max(level)+1):
+            print("\t%s: %s"%(l, ", ".join(n for n, k in zip(names, level) if k == l)))
+        i = finish.index(max(finish))
+        path = []
+        while i is not None:
+            path.insert(0, names[i])
+            i = prev[i]
+        if estimates:
+            print("Critical path: %s (%.0fs in the last build)"%(" -> ".join(path), max(finish)))
+        else:
+            print("Critical path: %s"%" -> ".join(path))
+
     def _run(self, commands):
         # Run a series of Builder commands
-        for c in commands:
-            # pass the args Namespace to the Builder.
-            c(self.args).run()
+        # pass the args Namespace to the Builder.
+        builders = [c(self.args) for c in commands]
+        if not self.args.parallel_steps or len(builders) < 2:
+            for b in builders:
+                self._step(b)
+            return
+
+        deps = self.schedule(builders)
+        self.print_schedule(builders, deps)
+        done = Queue.Queue()
+        def step(i):
+            try:
+                self._step(builders[i])
+                done.put((i, None))
+            except BaseException, e:
+                done.put((i, sys.exc_info()))
+
+        waiting, running, finished, error = set(range(len(builders))), set(), set(), None
+        while waiting or running:
+            if not error:
+                for i in sorted(waiting):
+                    if deps[i] <= finished:
+                        waiting.remove(i)
+                        running.add(i)
+                        t = threading.Thread(target=step, args=(i,))
+                        t.daemon = True
+                        t.start()
+            if not running:
+                break
+            i, exc = done.get()
+            running.remove(i)
+            finished.add(i)
+            if exc and not error:
+                error = exc
+        if error:
+            raise error[0], error[1], error[2]
+
+    @contextlib.contextmanager
+    def measure(self, step):
+        """Record wall time, CPU, peak RSS and bytes written for a step.
+
+        The peak RSS is the largest of the step's commands, or of build.py
+        itself when its high-water mark rose during the step.
+        """
+        before = resource_usage()
+        steplog = current_step_log()
+        status = 'failed'
+        try:
+            # Steps that run concurrently share the process-wide counters,
+            # so their CPU and I/O are counted for each of them.
+            yield
+            status = 'ok'
+        finally:
+            after = resource_usage()
+            m = dict((k, after[k] - before[k]) for k in ('wall', 'user', 'sys', 'written'))
+            maxrss = after['maxrss'] if after['maxrss'] > before['maxrss'] else 0
+            if steplog:
+                maxrss = max(maxrss, steplog.maxrss)
+            m.update(step=step, status=status, maxrss=maxrss)
+            self.metrics.append(m)
+            print("%s: %.1fs wall, %.1fs user, %.1fs sys, %.0f MB peak RSS, %.0f MB written"%(
+                step, m['wall'], m['user'], m['sys'], m['maxrss']/2.0**20, m['written']/2.0**20))
+
+    def save_metrics(self):
+        """Write the step metrics next to the image, and append them to the history database."""
+        now = datetime.datetime.utcnow().isoformat()
+        report = {'commit': self.args.commit, 'target': self.args.target_desc, 'release': self.args.release, 'date': now, 'steps': self.metrics}
+        mkdirs(self.args.cwd_images)
+        imgname = "%s.%s.%s.report.json"%(self.args.repository, self.args.release, self.args.target_desc)
+        with open(os.path.join(self.args.cwd_images, imgname), 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        record_steps(self.args, now, self.metrics)
+
+    def images(self):
+        """The images that package writes."""
+        imgname = "%s.%s.%s"%(self.args.repository, self.args.release, self.args.target_desc)
+        return [os.path.join(self.args.cwd_images, "%s.%s"%(imgname, i)) for i in self.args.formats.split(",")]
+
+    def fingerprint(self):
+        """Hash of the build inputs other than the commit: the extlib contents, the target config and build.py."""
+        h = hashlib.sha256()
+        config = dict((k, getattr(self.args, k, None)) for k in self.fingerprint_args)
+        h.update(json.dumps([self.__class__.__name__, config], sort_keys=True))
+        with open(os.path.abspath(__file__).replace('.pyc', '.py'), 'rb') as f:
+            h.update(hashlib.sha256(f.read()).digest())
+        # The dependency manifest: every file, symlink and mode in extlib/<distname>.
+        files, entries = [], []
+        for root, dirs, names in os.walk(self.args.cwd_extlib):
+            dirs.sort()
+            for name in sorted(dirs + names):
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                relpath = os.path.relpath(path, self.args.cwd_extlib)
+                if stat.S_ISLNK(st.st_mode):
+                    entries.append((relpath, 'link', os.readlink(path)))
+                elif stat.S_ISREG(st.st_mode):
+                    files.append(path)
+                    entries.append((relpath, oct(stat.S_IMODE(st.st_mode)), path))
+        mkdirs(os.path.dirname(self.args.history))
+        db = history_db(self.args.history)
+        try:
+            hashes = hash_files(files, db, self.args.threads)
+        finally:
+            db.close()
+        for relpath, kind, value in sorted(entries):
+            h.update("%s\0%s\0%s\n"%(relpath, kind, hashes.get(value, value)))
+        return h.hexdigest()
+
+    def ledger(self, db):
+        db.execute("""CREATE TABLE IF NOT EXISTS ledger (commit_id TEXT, target TEXT, release TEXT, fingerprint TEXT, images TEXT, date TEXT,
+            PRIMARY KEY (commit_id, target, release))""")
+        return db
+
+    def ledger_lookup(self, fingerprint):
+        """True if this commit was built with the same fingerprint, and its images are still in place."""
+        if not os.path.exists(self.args.history):
+            return False
+        db = history_db(self.args.history)
+        try:
+            row = self.ledger(db).execute("SELECT fingerprint, images FROM ledger WHERE commit_id=? AND target=? AND release=?",
+                (self.args.commit, self.args.target_desc, self.args.release)).fetchone()
+        finally:
+            db.close()
+        if not row or row[0] != fingerprint:
+            return False
+        images = json.loads(row[1])
+        if sorted(images) != sorted(self.images()):
+            return False
+        for path, (size, mtime) in images.items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                return False
+            if (st.st_size, st.st_mtime) != (size, mtime):
+                return False
+        return True
+
+    def ledger_record(self, fingerprint):
+        images = dict((path, (os.stat(path).st_size, os.stat(path).st_mtime)) for path in self.images())
+        db = history_db(self.args.history)
+        try:
+            with self.ledger(db):
+                db.execute("INSERT OR REPLACE INTO ledger VALUES (?,?,?,?,?,?)",
+                    (self.args.commit, self.args.target_desc, self.args.release, fingerprint, json.dumps(images), datetime.datetime.utcnow().isoformat()))
+        finally:
+            db.close()
 
     def run(self, commands):
-        for i in commands:
-            getattr(self, i)()
+        # A commit that was already packaged from the same inputs is not
+        # built again; upload, if requested, sends the existing images.
+        fingerprint = None
+        if 'package' in commands:
+            fingerprint = self.fingerprint()
+            if self.ledger_lookup(fingerprint):
+                if self.args.force:
+                    log("Commit %s was already built from the same inputs; rebuilding because of --force"%self.args.commit)
+                else:
+                    log("Commit %s was already built from the same inputs, reusing %s"%(self.args.commit, ", ".join(self.images())))
+                    commands = [i for i in commands if i not in self.producing]
+        try:
+            for i in commands:
+                getattr(self, i)()
+            if fingerprint and 'package' in commands:
+                if self.incomplete:
+                    log("Not recording commit %s in the ledger: %s had failures"%(self.args.commit, ", ".join(self.incomplete)))
+                else:
+                    self.ledger_record(fingerprint)
+        finally:
+            if self.metrics:
+                self.save_metrics()
+
+    def report(self):
+        """Show the wall time trend of each step, and flag regressions."""
+        if not os.path.exists(self.args.history):
+            print("No build history: %s"%self.args.history)
+            return
+        db = history_db(self.args.history)
+        rows = db.execute("SELECT step, date, commit_id, wall FROM steps WHERE target=? AND release=? AND status='ok' ORDER BY date",
+            (self.args.target_desc, self.args.release)).fetchall()
+        db.close()
+        history = collections.OrderedDict()
+        for step, date, commit, wall in rows:
+            history.setdefault(step, []).append((date, commit, wall))
+
+        log("Step timings for %s %s (last %s builds)"%(self.args.target_desc, self.args.release, self.args.history_size))
+        for step, runs in history.items():
+            runs = runs[-self.args.history_size:]
+            trend = " ".join("%.1f"%wall for date, commit, wall in runs)
+            flag = ""
+            previous = sorted(wall for date, commit, wall in runs[:-1])
+            if previous:
+                median = previous[len(previous)//2]
+                latest = runs[-1][2]
+                if median and latest > median * (1 + self.args.regression):
+                    flag = "REGRESSION: %.0fs vs median %.0fs at %s"%(latest, median, runs[-1][1])
+            print("%-20s %s %s"%(step, trend, flag))
         
+    def stored(self):
+        """List the stored images, and the space the store saves."""
+        store = ImageStore(self.args.cwd_store)
+        for path, m in store.manifests():
+            print("%-40s %-8s %-8s %s %8.1f MB"%(m['image'], m['release'], m['commit'][:7], m['date'][:19], m['size']/2.0**20))
+        used, total = store.usage()
+        print("%.1f MB stored for %.1f MB of images"%(used/2.0**20, total/2.0**20))
+
+    def prune_uploads(self):
+        """Remove the uploaded chunks that no image uses any more, once they are --upload-grace-days old."""
+        transport = upload_transport(self.args)
+        removed = transport.prune(int(self.args.upload_grace_days * 86400))
+        log("Removed %s unused chunks from %s"%(removed, transport))
+
+    def restore(self):
+        """Rebuild a stored image, --image from --restore-commit, into cwd_images or --output."""
+        image = self.args.image or os.path.basename(self.images()[0])
+        manifest = ImageStore(self.args.cwd_store).find(image, self.args.restore_commit)
+        if not manifest:
+            raise Exception, "No stored image %s%s"%(image, " from %s"%self.args.restore_commit if self.args.restore_commit else "")
+        output = self.args.output or os.path.join(self.args.cwd_images, image)
+        mkdirs(os.path.dirname(os.path.abspath(output)))
+        with open(output + '.tmp', 'wb') as out:
+            ImageStore(self.args.cwd_store).restore(manifest, out)
+        os.rename(output + '.tmp', output)
+        log("Restored %s from %s built %s"%(output, manifest['commit'], manifest['date']))
+
     def checkout(self):
         self._run([Checkout])
 
@@ -227,11 +1896,13 @@ class MacTarget(Target):
     """
     
     eman2install = None
+
+    pythonpath = ['lib', 'bin', 'extlib/site-packages', 'extlib/site-packages/ipython-1.2.1-py2.7.egg']
     
     bashrc = """#!/bin/sh
 export EMAN2DIR=/Applications/EMAN2/
 export PATH=$EMAN2DIR/bin:$EMAN2DIR/extlib/bin:$PATH
-export PYTHONPATH=$EMAN2DIR/lib:$EMAN2DIR/bin:$EMAN2DIR/extlib/site-packages:$EMAN2DIR/extlib/site-packages/ipython-1.2.1-py2.7.egg:$PYTHONPATH
+export PYTHONPATH=$EMAN2DIR/site:$PYTHONPATH
 export MATPLOTLIBRC=$EMAN2DIR/.config/matplotlibrc
 """
 
@@ -242,7 +1913,7 @@ if ( $?PYTHONPATH ) then
 else
 setenv PYTHONPATH
 endif
-setenv PYTHONPATH ${EMAN2DIR}/lib:${EMAN2DIR}/bin:${EMAN2DIR}/extlib/site-packages:${EMAN2DIR}/extlib/site-packages/ipython-1.2.1-py2.7.egg:${PYTHONPATH}
+setenv PYTHONPATH ${EMAN2DIR}/site:${PYTHONPATH}
 setenv MATPLOTLIBRC $EMAN2DIR/.config/matplotlibrc
 """
 
@@ -253,20 +1924,27 @@ setenv MATPLOTLIBRC $EMAN2DIR/.config/matplotlibrc
         self._run([CMakeBuild])
 
     def install(self):
-        self._run([FixLinks, FixInterpreter, CopyShrc, CopyExtlib, FixInstallNames])
+        self._run([FixLinks, FixInterpreter, CopyShrc, CopyExtlib, FixInstallNames, GenerateSite])
 
     def package(self):
-        self._run([MacPackage])
+        self._run(([StripBinaries] if self.args.strip else []) + ([CompilePython] if self.args.compile else []) + [MacPackage, StoreImages])
 
     def upload(self):
         self._run([MacUpload])
 
+    def images(self):
+        imgname = "%s.%s.%s.dmg"%(self.args.repository, self.args.release, self.args.target_desc)
+        return super(MacTarget, self).images() + [os.path.join(self.args.cwd_images, imgname)]
+
 class LinuxTarget(Target):
     target_desc = 'linux'
     def install(self): 
-        self._run([CopyShrc, CopyExtlib, FixLinuxRpath])
+        steps = [CopyShrc, CopyExtlib, FixLinuxRpath]
+        if self.args.prune:
+            steps.append(PruneExtlib)
+        self._run(steps)
     def package(self):
-        self._run([UnixPackage])
+        self._run(([StripBinaries] if self.args.strip else []) + ([CompilePython] if self.args.compile else []) + [UnixPackage, StoreImages])
     def upload(self):
         self._run([UnixUpload])
            
@@ -278,11 +1956,55 @@ class Linux64Target(LinuxTarget):
 
 class Builder(object):
     """Build step."""
+
+    # Set to False for steps that never add, remove or replace files in the stage.
+    writes_stage = True
+
+    # Executor for the step's per-file work, see executor()
+    _executor = None
+
+    # Failures reported by check() when they did not fail the step.
+    failures = ()
     
     def __init__(self, args):
         # Reference to Target configuration args Namespace
         self.args = args
+
+    @property
+    def index(self):
+        """Shared StageIndex of the staged install (cwd_rpath)."""
+        return stage_index(self.args.cwd_rpath)
+
+    def executor(self):
+        """Create an Executor for per-file commands, capped at --threads."""
+        self._executor = Executor(self.args.threads)
+        return self._executor
+
+    def call(self, args, **kwargs):
+        """Run a command, through the step's Executor when called from one of its tasks."""
+        if self._executor:
+            return self._executor.call(args, **kwargs)
+        return cmd(args, **kwargs)
+
+    def check(self, failures):
+        """Print a summary of failures; with --strict, fail the step."""
+        if not failures:
+            return
+        self.failures = failures
+        print("%s: %s failures"%(self.__class__.__name__, len(failures)))
+        for key, msg in failures:
+            print("\t%s: %s"%(key, msg))
+        if self.args.strict:
+            raise Exception, "%s failed for %s files"%(self.__class__.__name__, len(failures))
     
+    def reads(self):
+        """Paths this step reads, used by Target to schedule steps concurrently."""
+        return [self.args.cwd_stage]
+
+    def writes(self):
+        """Paths this step modifies. Steps that do not declare any are run alone."""
+        return [self.args.cwd_stage]
+
     #@abstractmethod
     def run(self):
         """Each builder class must implement run()."""
@@ -290,63 +2012,368 @@ class Builder(object):
 
 # Checkout command.
 class Checkout(Builder):
-    """Copy EMAN2 source code from github repository on build machine to this VM."""
-    
-    def run(self):
-        log("Checking out: %s -r %s"%(self.args.repository, self.args.cvstag))
+    """Copy EMAN2 source code from github repository on build machine to this VM.
+
+    One bare mirror of --remote is kept in co/<repository>.git and
+    updated with an incremental fetch. Each release directory
+    (co/eman2.daily, ...) is a worktree of the mirror at --ref, or with
+    git older than 2.5, which has no worktrees, a clone --shared of it.
+    Updating it only rewrites the files that changed, and the untouched
+    files keep their mtimes for make. The files changed since the
+    previous checkout are listed in co/<distname>.changed.
+    """
+    writes_stage = False
 
-        cwd = os.getcwd()
-        os.chdir("co")
+    def reads(self):
+        return []
 
-        cmd(["git","clone","git@github.com:cryoem/eman2.git","eman2.tmp"])
-        cmd(["rm","-rf","eman2.daily/.git"])
-        cmd(["mv","eman2.tmp/.git/","eman2.daily/.git"])
-        cmd(["rm","-rf","eman2.tmp"])
-        
-        os.chdir(cwd)
+    def writes(self):
+        return [self.args.cwd_co]
+
+    def git(self, *args, **kwargs):
+        if cmd(['git'] + list(args), **kwargs):
+            raise Exception, "git %s failed"%" ".join(args)
+
+    def git_version(self):
+        """(major, minor) of the git on the path, e.g. (1, 8) on CentOS 7."""
+        return tuple(int(i) for i in re.findall(r'\d+', check_output(['git', '--version']))[:2])
+
+    def rev_parse(self, gitdir, ref):
+        try:
+            return check_output(['git', '--git-dir', gitdir, 'rev-parse', '--verify', '-q', ref+'^{commit}'], stderr=open(os.devnull, 'w')).strip()
+        except subprocess.CalledProcessError:
+            return None
+
+    def run(self):
+        log("Checking out: %s -r %s"%(self.args.repository, self.args.cvstag))
+        mkdirs(self.args.cwd_co)
+        # Builds of other releases in the same root share the mirror.
+        with file_lock(self.args.cwd_mirror + '.lock'):
+            self.update()
+
+    def update(self):
+        mirror = self.args.cwd_mirror
+        worktree = self.args.cwd_co_distname
+
+        if os.path.isdir(mirror):
+            self.git('--git-dir', mirror, 'remote', 'set-url', 'origin', self.args.remote)
+            self.git('--git-dir', mirror, 'fetch', '--prune', 'origin')
+        else:
+            self.git('clone', '--mirror', self.args.remote, mirror)
+        commit = self.rev_parse(mirror, self.args.ref)
+        if not commit:
+            raise Exception, "Unknown ref %s in %s"%(self.args.ref, self.args.remote)
+
+        # A release directory from the old full clones is replaced by a
+        # worktree (a .git file), or a shared clone (.git with alternates).
+        worktrees = self.git_version() >= (2, 5)
+        gitdir = os.path.join(worktree, '.git')
+        previous = None
+        if os.path.isfile(gitdir) if worktrees else os.path.isfile(os.path.join(gitdir, 'objects', 'info', 'alternates')):
+            previous = self.rev_parse(gitdir, 'HEAD')
+        else:
+            rmtree(worktree)
+        if worktrees:
+            self.git('--git-dir', mirror, 'worktree', 'prune')
+        if os.path.isdir(worktree):
+            self.git('checkout', '-q', '--force', '--detach', commit, cwd=worktree)
+            self.git('clean', '-q', '-fdx', cwd=worktree)
+        elif worktrees:
+            self.git('--git-dir', mirror, 'worktree', 'add', '--detach', worktree, commit)
+        else:
+            # The objects stay in the mirror; the clone only borrows them.
+            self.git('clone', '-q', '--shared', '--no-checkout', mirror, worktree)
+            self.git('checkout', '-q', '--detach', commit, cwd=worktree)
+        log("Checked out %s at %s"%(self.args.ref, commit))
+
+        changed = None
+        if previous:
+            changed = filter(None, check_output(['git', '--git-dir', mirror, 'diff', '--name-only', previous, commit]).split('\n'))
+            print("%s files changed since %s"%(len(changed), previous[:7]))
+            for i in changed[:20]:
+                print("    %s"%i)
+        with open(worktree+'.changed', 'w') as f:
+            if changed is not None:
+                f.write("".join(i+'\n' for i in changed))
 
 # Build sub-command.
 class CMakeBuild(Builder):
-    """Run cmake, build, and install."""
-    def run(self):
-        log("Building")
+    """Run cmake, build, and install.
+
+    With --incremental, the build directory and the stage are kept.
+    cmake only runs again when the CMakeLists, the *.cmake files or the
+    cmake arguments change. make install only copies files that changed,
+    and files that the previous install_manifest.txt listed but the new
+    one does not are removed from the stage. When ccache is available
+    it is put in front of the compilers, and its hit rate is printed
+    after make. cmake 3.4 and later take ccache as a compiler launcher;
+    older ones, like the 2.6 that install-dependencies.py builds, get it
+    through CC and CXX.
+    """
+    def reads(self):
+        return [self.args.cwd_co_distname]
+
+    def writes(self):
+        return [self.args.cwd_build, self.args.cwd_stage]
 
-        print("Removing previous install: %s"%self.args.cwd_stage)
-        retree(self.args.cwd_stage)
+    def cmake_args(self):
+        args = ['cmake', self.args.cwd_co_distname]
+        if self.ccache() and self.cmake_version() >= (3, 4):
+            args += ['-DCMAKE_C_COMPILER_LAUNCHER=ccache', '-DCMAKE_CXX_COMPILER_LAUNCHER=ccache']
+        return args
 
-        print("Running cmake")
-        print self.args.cwd_co_distname
-        print self.args.cwd_build
-        cmd(['cmake', self.args.cwd_co_distname], cwd=self.args.cwd_build)
+    def cmake_env(self):
+        """Compiler variables for cmake versions without launcher support."""
+        if self.ccache() and self.cmake_version() < (3, 4):
+            return {'CC': 'ccache %s'%os.environ.get('CC', 'cc'), 'CXX': 'ccache %s'%os.environ.get('CXX', 'c++')}
+        return {}
+
+    def ccache(self):
+        return self.args.ccache and distutils.spawn.find_executable('ccache')
+
+    def cmake_version(self):
+        """(major, minor) of the cmake on the PATH, or () if it cannot be run."""
+        try:
+            output = check_output(['cmake', '--version'])
+        except (OSError, subprocess.CalledProcessError):
+            return ()
+        m = re.search(r'version (\d+)\.(\d+)', output)
+        return (int(m.group(1)), int(m.group(2))) if m else ()
+
+    def configure_hash(self, args):
+        """Hash of everything that decides whether cmake has to run again."""
+        h = hashlib.sha256(json.dumps(args))
+        for root, dirs, files in os.walk(self.args.cwd_co_distname):
+            dirs[:] = sorted(d for d in dirs if d != '.git')
+            for name in sorted(files):
+                if name == 'CMakeLists.txt' or name.endswith('.cmake'):
+                    path = os.path.join(root, name)
+                    h.update(os.path.relpath(path, self.args.cwd_co_distname) + '\0')
+                    with open(path, 'rb') as f:
+                        h.update(hashlib.sha256(f.read()).digest())
+        return h.hexdigest()
+
+    def manifest(self):
+        """Files listed by the last make install."""
+        try:
+            with open(os.path.join(self.args.cwd_build, 'install_manifest.txt')) as f:
+                return set(filter(None, f.read().split('\n')))
+        except IOError:
+            return set()
+
+    def hit_rate(self):
+        """ccache hits and misses since the last ccache -z."""
+        stats = check_output(['ccache', '-s'])
+        # ccache 3.x: "cache hit (direct)  12"; ccache 4.x: "Hits:  12 / 15 (80.00 %)"
+        m = re.search(r'^\s*Hits:\s+(\d+)\s*/\s*(\d+)', stats, re.M)
+        if m:
+            return int(m.group(1)), int(m.group(2)) - int(m.group(1))
+        hits = sum(int(i) for i in re.findall(r'^cache hit \(\w+\)\s+(\d+)', stats, re.M))
+        misses = sum(int(i) for i in re.findall(r'^cache miss\s+(\d+)', stats, re.M))
+        return hits, misses
 
-        if self.args.clean:
+    def run(self):
+        log("Building")
+        incremental = self.args.incremental
+
+        if not incremental:
+            print("Removing previous install: %s"%self.args.cwd_stage)
+            retree(self.args.cwd_stage)
+        mkdirs(self.args.cwd_build)
+
+        args = self.cmake_args()
+        env = self.cmake_env()
+        stamp = os.path.join(self.args.cwd_build, '.configure.sha256')
+        digest = self.configure_hash(args + ['%s=%s'%i for i in sorted(env.items())])
+        try:
+            with open(stamp) as f:
+                configured = f.read().strip()
+        except IOError:
+            configured = None
+        if incremental and configured == digest and os.path.exists(os.path.join(self.args.cwd_build, 'CMakeCache.txt')):
+            print("cmake inputs are unchanged, not reconfiguring")
+        else:
+            print("Running cmake")
+            print self.args.cwd_co_distname
+            print self.args.cwd_build
+            if cmd(args, cwd=self.args.cwd_build, echo=True, env=dict(os.environ, **env)) == 0:
+                with open(stamp, 'w') as f:
+                    f.write(digest+'\n')
+            else:
+                if os.path.exists(stamp):
+                    os.unlink(stamp)
+                raise Exception, "cmake failed"
+
+        if self.args.clean and not incremental:
             print("Running make clean")
-            cmd(['make', 'clean'], cwd=self.args.cwd_build)
+            if cmd(['make', 'clean'], cwd=self.args.cwd_build):
+                raise Exception, "make clean failed"
+
+        ccache = self.ccache()
+        if ccache:
+            check_output(['ccache', '-z'])
 
+        # Under a matrix build, make takes its job slots from the shared jobserver.
+        jobs = ['-j{}'.format(self.args.threads)]
+        if '--jobserver-fds' in os.environ.get('MAKEFLAGS', ''):
+            jobs = []
         print("Running make")
-        cmd(['make','-j{}'.format(self.args.threads)], cwd=self.args.cwd_build)
+        if cmd(['make'] + jobs, cwd=self.args.cwd_build, echo=True):
+            raise Exception, "make failed"
+
+        if ccache:
+            hits, misses = self.hit_rate()
+            log("ccache: %s hits, %s misses (%.0f%%)"%(hits, misses, 100.0*hits/max(hits+misses, 1)))
 
+        previous = self.manifest()
         print("Running make install")
-        cmd(['make', 'install'], cwd=self.args.cwd_build)
+        if cmd(['make', 'install'], cwd=self.args.cwd_build, echo=True):
+            raise Exception, "make install failed"
+        if incremental:
+            # Drop what the sources no longer install.
+            stale = previous - self.manifest()
+            for path in sorted(stale):
+                if os.path.lexists(path) and not os.path.isdir(path):
+                    os.unlink(path)
+            if stale:
+                print("Removed %s stale files from the stage"%len(stale))
 
 # Build sub-command.
 class CopyExtlib(Builder):
+    """Copy extlib/<distname> into the stage.
+
+    With --extlib-copy auto, each file is cloned with a reflink where the
+    filesystem supports it. Otherwise it is hardlinked, unless it is a
+    binary or script that later steps patch in place, and the remaining
+    files are copied in parallel. Steps that patch files call
+    break_link() first, so extlib/<distname> itself is never modified.
+
+    A copy is kept, e.g. by --incremental, only while extlib/<distname>
+    matches the manifest hash recorded next to it in the stage, outside
+    the packaged tree.
+    """
+    def reads(self):
+        return [self.args.cwd_extlib]
+
+    def writes(self):
+        extlib = os.path.join(self.args.cwd_rpath, 'extlib')
+        return [extlib, extlib + '.partial', self.stamp()]
+
+    def stamp(self):
+        return os.path.join(self.args.cwd_stage, '.extlib.sha256')
+
+    def manifest_hash(self):
+        """Hash of the names, modes, sizes, mtimes and links in extlib/<distname>."""
+        h = hashlib.sha256()
+        src = self.args.cwd_extlib
+        for root, dirs, names in os.walk(src):
+            dirs.sort()
+            for name in sorted(dirs + names):
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                link = os.readlink(path) if stat.S_ISLNK(st.st_mode) else ''
+                h.update("%s\0%o\0%d\0%r\0%s\n"%(os.path.relpath(path, src), st.st_mode, st.st_size, st.st_mtime, link))
+        return h.hexdigest()
+
+    def copy(self, src, dst, kind):
+        """Copy one file with the first method that works; returns the method used."""
+        mode = self.args.extlib_copy
+        if mode in ('auto', 'reflink'):
+            try:
+                reflink(src, dst)
+                shutil.copystat(src, dst)
+                return 'reflink'
+            except (IOError, OSError):
+                if mode == 'reflink':
+                    raise
+        if mode in ('auto', 'hardlink') and kind not in (ELF, MACHO, SCRIPT):
+            try:
+                os.link(src, dst)
+                return 'hardlink'
+            except OSError:
+                if mode == 'hardlink':
+                    raise
+        copy_file(src, dst)
+        return 'copy'
+
     def run(self):
         log("Copying dependencies")
         #print(self.args.cwd_extlib, "->", self.args.cwd_rpath_extlib)
         self.args.cwd_rpath_extlib = os.path.join(self.args.cwd_rpath,"extlib")
+        digest = self.manifest_hash()
         if os.path.isdir(self.args.cwd_rpath_extlib):
-            log("Dependencies have already been copied")
-        else:
             try:
-                shutil.copytree(self.args.cwd_extlib, self.args.cwd_rpath_extlib, symlinks=True)
-                log("Dependencies have been copied successfully")
-            except:
-                print "ERROR$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$"
-                pass
+                with open(self.stamp()) as f:
+                    copied = f.read().strip()
+            except IOError:
+                copied = None
+            if copied == digest:
+                log("Dependencies have already been copied")
+                return
+            log("Dependencies have changed since they were copied, copying them again")
+            rmtree(self.args.cwd_rpath_extlib)
+            stage_index(self.args.cwd_extlib).invalidate()
+        if os.path.exists(self.stamp()):
+            os.unlink(self.stamp())
+
+        src = self.args.cwd_extlib
+        dst = self.args.cwd_rpath_extlib + '.partial'
+        rmtree(dst)
+        failures = []
+        dirs = []
+        executor = self.executor()
+        sizes = {}
+        for f in stage_index(src).files():
+            sizes[f.path] = f.size
+            # The directories have to exist before the workers need them.
+            d = os.path.dirname(os.path.join(dst, f.relpath))
+            if not os.path.isdir(d):
+                os.makedirs(d)
+            executor.submit(f.relpath, functools.partial(self.copy, f.path, os.path.join(dst, f.relpath), f.kind))
+        # Directories and symlinks, which the index does not include.
+        for root, dirnames, filenames in os.walk(src):
+            for name in dirnames + filenames:
+                path = os.path.join(root, name)
+                target = os.path.join(dst, os.path.relpath(path, src))
+                try:
+                    if os.path.islink(path):
+                        os.symlink(os.readlink(path), target)
+                    elif os.path.isdir(path):
+                        mkdirs(target)
+                        dirs.append((path, target))
+                except OSError, e:
+                    failures.append((os.path.relpath(path, src), str(e)))
+
+        counts = collections.Counter()
+        for relpath, results in executor.join():
+            if results:
+                counts[results[0]] += sizes[os.path.join(src, relpath)]
+        failures.extend(executor.failures)
+        for path, target in reversed(dirs):
+            shutil.copystat(path, target)
+        shutil.copystat(src, dst)
+
+        print(", ".join("%s: %.0f MB"%(k, v/2.0**20) for k, v in sorted(counts.items())))
+        # A strict failure leaves the partial copy aside, so the next run starts over.
+        if not (failures and self.args.strict):
+            os.rename(dst, self.args.cwd_rpath_extlib)
+        # A copy with failures is never kept by a later run.
+        if not failures:
+            with open(self.stamp(), 'w') as f:
+                f.write(digest + '\n')
+        self.check(failures)
+        log("Dependencies have been copied")
 
 # Build sub-command.
 class CopyShrc(Builder):
+    def reads(self):
+        return []
+
+    def writes(self):
+        return [os.path.join(self.args.cwd_stage, 'INSTALL.txt'),
+                os.path.join(self.args.cwd_rpath, 'eman2.bashrc'),
+                os.path.join(self.args.cwd_rpath, 'eman2.cshrc')]
+
     def run(self):
         log("Copying INSTALL.txt and shell rc files")
         mkdirs(os.path.join(self.args.cwd_stage))
@@ -361,132 +2388,942 @@ class CopyShrc(Builder):
             with open(os.path.join(self.args.cwd_rpath, 'eman2.cshrc'), 'w') as f:
                  f.write(self.args.cshrc)
 
+# site/ replaces the PYTHONPATH of the rc files: PYTHONPATH=$EMAN2DIR/site
+# makes Python import this sitecustomize, which adds the directories in
+# eman2.pth, the ones the rc files used to list (Target.pythonpath), and
+# with Python 2 finds top level EMAN2 modules from modules.idx without
+# searching sys.path. EMAN2_IMPORT_INDEX=0 turns the index off.
+SITECUSTOMIZE = r"""# Generated by build.py.
+import os, sys, site
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+
+def _addsitedirs():
+    before = list(sys.path)
+    with open(os.path.join(here, 'eman2.pth')) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                site.addsitedir(os.path.join(root, line))
+    # Right after site/, where PYTHONPATH used to put them.
+    added = [p for p in sys.path if p not in before]
+    i = before.index(here) + 1 if here in before else 0
+    sys.path[:] = before[:i] + added + before[i:]
+
+class _IndexFinder(object):
+    def __init__(self, index):
+        self.index = index
+
+    def find_module(self, fullname, path=None):
+        if path is None and fullname in self.index:
+            return self
+        return None
+
+    def load_module(self, fullname):
+        import imp
+        if fullname in sys.modules:
+            return sys.modules[fullname]
+        path = os.path.join(root, self.index[fullname])
+        if os.path.isdir(path):
+            return imp.load_module(fullname, None, path, ('', '', imp.PKG_DIRECTORY))
+        for suffix, mode, kind in imp.get_suffixes():
+            if path.endswith(suffix):
+                f = open(path, mode)
+                try:
+                    return imp.load_module(fullname, f, path, (suffix, mode, kind))
+                finally:
+                    f.close()
+        raise ImportError(fullname)
+
+def _index():
+    index = {}
+    try:
+        with open(os.path.join(here, 'modules.idx')) as f:
+            for line in f:
+                name, relpath = line.rstrip('\n').split('\t')
+                index[name] = relpath
+    except IOError:
+        return
+    sys.meta_path.append(_IndexFinder(index))
+
+def _chain():
+    # Run the sitecustomize this one hides, if there is one.
+    import imp
+    try:
+        f, pathname, description = imp.find_module('sitecustomize', [p for p in sys.path if os.path.abspath(p or '.') != here])
+    except ImportError:
+        return
+    try:
+        imp.load_module('_sitecustomize', f, pathname, description)
+    finally:
+        if f:
+            f.close()
+
+_addsitedirs()
+if sys.version_info[0] == 2 and os.environ.get('EMAN2_IMPORT_INDEX', '1') != '0':
+    _index()
+_chain()
+"""
+
+class GenerateSite(Builder):
+    """Write site/: the sitecustomize, eman2.pth and modules.idx that replace PYTHONPATH.
+
+    The directories are the target's pythonpath. When --site-benchmark
+    is set, the startup of the first --profile-entries script is timed
+    with the old PYTHONPATH and with site/, and the medians are printed
+    and written to site.json.
+    """
+
+    def reads(self):
+        return [self.args.cwd_stage]
+
+    def writes(self):
+        return [os.path.join(self.args.cwd_rpath, 'site'), self.args.cwd_images]
+
+    def modules(self, dirs):
+        """Top level modules and packages as (name, path relative to the install); the first of a name wins."""
+        seen = set()
+        for d in dirs:
+            if not os.path.isdir(os.path.join(self.args.cwd_rpath, d)):
+                continue
+            for name in sorted(os.listdir(os.path.join(self.args.cwd_rpath, d))):
+                path = os.path.join(self.args.cwd_rpath, d, name)
+                if os.path.isdir(path):
+                    module = name if os.path.exists(os.path.join(path, '__init__.py')) and re.match(r'\w+$', name) else None
+                else:
+                    m = re.match(r'(\w+)\.py$', name) or re.match(r'(\w+?)(module)?\.so$', name)
+                    module = m.group(1) if m else None
+                if module and module not in seen:
+                    seen.add(module)
+                    yield module, os.path.join(d, name)
+
+    def startup(self, env, entry):
+        """Wall time of importing a bin/ script in a new interpreter."""
+        start = time.time()
+        subprocess.call([self.args.python, '-c', 'import imp, sys; imp.load_source("__profiled__", sys.argv[1])',
+            os.path.join(self.args.cwd_rpath, 'bin', entry)], env=env, cwd=self.args.cwd_rpath,
+            stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+        return time.time() - start
+
+    def benchmark(self, dirs):
+        entries = [i for i in self.args.profile_entries.split(',') if i and os.path.exists(os.path.join(self.args.cwd_rpath, 'bin', i))]
+        if not entries:
+            return
+        if not python_version(self.args.python):
+            print("Not benchmarking, %s does not run"%self.args.python)
+            return
+        stage = self.args.cwd_rpath
+        env = dict(os.environ, EMAN2DIR=stage)
+        before = dict(env, PYTHONPATH=":".join(os.path.join(stage, i) for i in dirs))
+        after = dict(env, PYTHONPATH=os.path.join(stage, 'site'))
+        times = {'before': [], 'after': []}
+        for i in range(self.args.site_benchmark):
+            times['before'].append(self.startup(before, entries[0]))
+            times['after'].append(self.startup(after, entries[0]))
+        median = dict((k, sorted(v)[len(v)//2]) for k, v in times.items())
+        print("Startup of %s: %.0f ms with PYTHONPATH, %.0f ms with site/ (median of %s)"%(
+            entries[0], median['before']*1000, median['after']*1000, self.args.site_benchmark))
+        mkdirs(self.args.cwd_images)
+        with open(os.path.join(self.args.cwd_images, 'site.json'), 'w') as f:
+            json.dump({'entry': entries[0], 'times': times, 'median': median}, f, indent=1, sort_keys=True)
+
+    def run(self):
+        if not self.args.pythonpath:
+            return
+        log("Writing site/")
+        site = os.path.join(self.args.cwd_rpath, 'site')
+        retree(site)
+        dirs = self.args.pythonpath
+        with open(os.path.join(site, 'eman2.pth'), 'w') as f:
+            f.write("".join(i+'\n' for i in dirs))
+        with open(os.path.join(site, 'sitecustomize.py'), 'w') as f:
+            f.write(SITECUSTOMIZE)
+        if self.args.import_index:
+            modules = list(self.modules(dirs))
+            with open(os.path.join(site, 'modules.idx'), 'w') as f:
+                f.write("".join("%s\t%s\n"%i for i in modules))
+            print("Indexed %s modules"%len(modules))
+        if self.args.site_benchmark:
+            self.benchmark(dirs)
+
 # Build sub-command.
 class FixInterpreter(Builder):
     """Fix the Python interpreter to point to /usr/bin/python<commit>."""
+    writes_stage = False
+    _scope = None
+
+    def reads(self):
+        return self.writes()
+
+    def writes(self):
+        # Everything in the install except the dependencies in extlib/ (and
+        # extlib.partial/ while CopyExtlib runs). The scope is fixed when the
+        # step is scheduled, so it is the same one the scheduler saw.
+        if self._scope is None:
+            names = os.listdir(self.args.cwd_rpath) if os.path.isdir(self.args.cwd_rpath) else []
+            self._scope = [os.path.join(self.args.cwd_rpath, i) for i in sorted(names) if not i.startswith('extlib')]
+        return self._scope
+
+    def fix(self, path):
+        """Replace the hashbang of one script, streaming the rest into a new file."""
+        with open(path, 'rb') as src:
+            if not src.readline().startswith("#!"):
+                return
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.'+os.path.basename(path))
+            try:
+                with os.fdopen(fd, 'wb') as dst:
+                    dst.write("#!%s\n"%self.args.python)
+                    shutil.copyfileobj(src, dst, 1<<20)
+                shutil.copystat(path, tmp)
+                # The rename also replaces a hardlink into extlib/<distname>.
+                os.rename(tmp, path)
+            except:
+                os.unlink(tmp)
+                raise
+
     def run(self):
         log("Fixing Python interpreter hashbang")
-        for i in find_ext('.py', root=self.args.cwd_rpath):
-            # print i
-            with open(i) as f:
-                data = f.readlines()
-            if data and data[0].startswith("#!") and "python" in data[0]:
-                data[0] = "#!%s\n"%self.args.python
-                with open(i, "w") as f:
-                    f.writelines(data)
+        scope = self.writes()
+        bindir = os.path.join(self.args.cwd_rpath, 'bin')
+        executor = self.executor()
+        # Python scripts, and any python hashbang script in bin/.
+        # The index has already read the first line of each script.
+        for f in self.index.files():
+            if f.kind != SCRIPT or "python" not in f.shebang or f.shebang == "#!%s"%self.args.python:
+                continue
+            if not (f.path.endswith('.py') or overlaps(f.path, bindir)):
+                continue
+            if any(overlaps(f.path, i) for i in scope):
+                executor.submit(f.path, functools.partial(self.fix, f.path))
+        for path, results in executor.join():
+            self.index.refresh(path)
+        self.check(executor.failures)
 
 # Build sub-command. Mac specific.
 class FixLinks(Builder):
+    def reads(self):
+        return [self.args.cwd_rpath_lib]
+
+    def writes(self):
+        return [self.args.cwd_rpath_lib]
+
     def run(self):
         log("Creating .dylib -> .so links for Python")
-        # Need to set the current working directory for os.symlink
-        cwd = os.getcwd()
-        os.chdir(self.args.cwd_rpath_lib)
-        for f in glob.glob("*.dylib"):
+        # Relative links, without changing the working directory of other running steps.
+        for f in glob.glob(os.path.join(self.args.cwd_rpath_lib, "*.dylib")):
+            f = os.path.basename(f)
             # print f, "->", f.replace(".dylib", ".so")
             try:
-                os.symlink(f, f.replace(".dylib", ".so"))
+                os.symlink(f, os.path.join(self.args.cwd_rpath_lib, f.replace(".dylib", ".so")))
             except:
                 pass
-        os.chdir(cwd)
 
-##### EXPERIMENTAL !!!! ######
 # Set rpath $ORIGIN so LD_LIBRARY_PATH is not needed on Linux.
-# This should work on all modern Linux systems.
-# However, the code below is a little hacky and could be cleaned up.
+# The rpath is rewritten directly in the dynamic string table when
+# it fits, and with patchelf otherwise. A before/after report
+# is written to images/<distname>/rpath.json.
 class FixLinuxRpath(Builder):
+    writes_stage = False
+
+    def fix(self, path, rpath):
+        """Set the rpath of one ELF file, in place if possible. Returns a report entry."""
+        entry = {'file': os.path.relpath(path, self.args.cwd_rpath), 'before': None, 'after': None, 'method': None}
+        try:
+            with ElfFile(path) as elf:
+                if elf.strtab is not None and elf.rpath() == rpath:
+                    entry.update(before=rpath, after=rpath, method='unchanged')
+                    return entry
+            break_link(path)
+            with writable(path), ElfFile(path, write=True) as elf:
+                if elf.strtab is None:
+                    entry['method'] = 'static'
+                    return entry
+                entry['before'] = elf.rpath()
+                if entry['before'] == rpath:
+                    entry['method'] = 'unchanged'
+                elif elf.set_rpath(rpath):
+                    entry['method'] = 'inplace'
+            if not entry['method']:
+                # No rpath entry yet, or the new one is longer: the string table has to grow.
+                entry['method'] = 'patchelf'
+                with writable(path):
+                    if self.call(['patchelf', '--set-rpath', rpath, path]):
+                        entry['method'] = 'failed'
+            with ElfFile(path) as elf:
+                entry['after'] = elf.rpath()
+        except (IOError, OSError, ValueError, struct.error), e:
+            entry['method'] = 'failed'
+            entry['error'] = str(e)
+        return entry
+
     def run(self):
         log("Fixing rpath")
-        targets = set()
-        targets |= set(find_ext('.so', root=self.args.cwd_rpath))
-        targets |= set(find_ext('.dylib', root=self.args.cwd_rpath))
-        targets |= set(find_exec(root=self.args.cwd_rpath))
-
-        for target in sorted(targets):
-            if ".py" in target or "extlib/lib/python2.7" in target:
+        executor = self.executor()
+        for f in self.index.files():
+            if f.kind != ELF or "extlib/lib/python2.7" in f.path:
                 continue
-            xtarget = target.replace(self.args.cwd_rpath, '')
-            depth = len(xtarget.split('/'))-2
+            depth = len(f.relpath.split('/'))-1
             origins = ['$ORIGIN/']
             base = "".join(["../"]*depth)
             for i in ['extlib/lib']: #, 'extlib/python/lib', 'extlib/qt4/lib'
                 origins.append('$ORIGIN/'+base+i+'/')
-            try:
-                # print ['patchelf', '--set-rpath', ":".join(origins), target]
-                cmd(['patchelf', '--set-rpath', ":".join(origins), target])
-                cmd(['readelf', '--print-rpath', target])
-                cmd(['objdump', '-x', target, '|', 'grep', 'RPATH'])
-            except Exception, e:
-                print "Couldnt patchelf:", e        
+            executor.submit(f.path, functools.partial(self.fix, f.path, ":".join(origins)))
+
+        report = []
+        failures = []
+        for path, results in executor.join():
+            self.index.refresh(path)
+            if results:
+                report.append(results[0])
+                if results[0]['method'] == 'failed':
+                    failures.append((path, results[0].get('error', 'patchelf failed')))
+        failures.extend(i for i in executor.failures if i[0] not in dict(failures))
+
+        counts = collections.Counter(i['method'] for i in report)
+        print(", ".join("%s: %s"%(k, v) for k, v in sorted(counts.items())))
+        mkdirs(self.args.cwd_images)
+        with open(os.path.join(self.args.cwd_images, 'rpath.json'), 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        self.check(failures)
         
+# Loaded with dlopen() or imported from C code, so the analysis cannot see them.
+PRUNE_KEEP = ('lib/libpython*', 'lib/*/plugins/*', 'plugins/*', 'lib/python2.7/site-packages/sip*')
+
+class PruneExtlib(Builder):
+    """Remove the extlib libraries and site-packages that nothing loads.
+
+    The Python modules of EMAN2 are scanned for imports, which decides
+    the site-packages entries to keep, and the modules of those are
+    scanned in turn. Then, from every other ELF file in the stage, the
+    DT_NEEDED closure is resolved through each file's rpath and
+    extlib/lib. Shared and static libraries in extlib/lib outside the
+    closure, and importable site-packages entries that are never
+    imported, are removed, except for PRUNE_KEEP and --prune-keep.
+    """
+    def reads(self):
+        return [self.args.cwd_stage]
+
+    def writes(self):
+        return [self.args.cwd_rpath_extlib]
+
+    def imports(self, path):
+        """Top level names of the absolute imports in a Python file."""
+        with open(path) as f:
+            source = f.read()
+        try:
+            tree = ast.parse(source, path)
+        except (SyntaxError, TypeError, ValueError):
+            return set(re.findall(r'^\s*(?:from|import)\s+(\w+)', source, re.M))
+        names = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names.update(alias.name.split('.')[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                names.add(node.module.split('.')[0])
+        return names
+
+    def site_packages(self, sitedir):
+        """Map each importable top level name to the site-packages entries that provide it."""
+        provides = collections.defaultdict(set)
+        def add(directory, entry):
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if os.path.isdir(path):
+                    if os.path.exists(os.path.join(path, '__init__.py')):
+                        provides[name].add(entry or path)
+                else:
+                    module = re.match(r'(\w+?)(module)?\.(py|pyc|pyo|so)$', name)
+                    if module:
+                        provides[module.group(1)].add(entry or path)
+        add(sitedir, None)
+        for name in os.listdir(sitedir):
+            path = os.path.join(sitedir, name)
+            if name.endswith('.egg'):
+                # The modules of an egg come with the egg.
+                if os.path.isdir(path):
+                    add(path, path)
+                elif zipfile.is_zipfile(path):
+                    for i in zipfile.ZipFile(path).namelist():
+                        provides[re.split(r'[/.]', i)[0]].add(path)
+            elif name.endswith('.pth'):
+                # Directories that a .pth adds to sys.path.
+                with open(path) as f:
+                    for line in f:
+                        d = os.path.join(sitedir, line.strip())
+                        if line.strip() and not line.startswith(('#', 'import')) and os.path.isdir(d) and os.path.dirname(os.path.normpath(d)) == sitedir:
+                            add(d, os.path.normpath(d))
+        return provides
+
+    def kept(self, path, extlib, keep):
+        relpath = os.path.relpath(path, extlib)
+        return any(fnmatch.fnmatch(relpath, i) for i in keep)
+
+    def resolve(self, path, name, fallback):
+        """The file a DT_NEEDED name of path loads, or None for system libraries."""
+        with ElfFile(path) as elf:
+            rpath = elf.rpath() or ''
+        dirs = [i.replace('$ORIGIN', os.path.dirname(path)).replace('${ORIGIN}', os.path.dirname(path)) for i in rpath.split(':') if i]
+        for d in dirs + fallback:
+            candidate = os.path.normpath(os.path.join(d, name))
+            if os.path.exists(candidate) and candidate.startswith(self.args.cwd_rpath + os.sep):
+                return candidate
+        return None
+
+    def run(self):
+        log("Pruning extlib")
+        stage = self.args.cwd_rpath
+        extlib = os.path.join(stage, 'extlib')
+        libdir = os.path.join(extlib, 'lib')
+        sitedir = os.path.join(libdir, 'python2.7', 'site-packages')
+        keep = PRUNE_KEEP + tuple(filter(None, self.args.prune_keep.split(',')))
+        files = self.index.files()
+        inside = lambda path, d: path == d or path.startswith(d + os.sep)
+
+        # Python: the site-packages entries that EMAN2 imports, and what those import.
+        provides = self.site_packages(sitedir) if os.path.isdir(sitedir) else {}
+        entries = set(e for es in provides.values() for e in es)
+        used = set(e for e in entries if self.kept(e, extlib, keep))
+        queue = [f.path for f in files if not inside(f.path, extlib) and
+            (f.path.endswith('.py') or (f.kind == SCRIPT and 'python' in (f.shebang or '')))]
+        queue += [f.path for f in files if f.path.endswith('.py') for e in used if inside(f.path, e)]
+        scanned = set()
+        while queue:
+            path = queue.pop()
+            if path in scanned:
+                continue
+            scanned.add(path)
+            for name in self.imports(path):
+                for e in provides.get(name, ()):
+                    if e not in used:
+                        used.add(e)
+                        queue.extend(f.path for f in files if f.path.endswith('.py') and inside(f.path, e))
+        unused = entries - used
+
+        # Libraries: the DT_NEEDED closure of every ELF file that stays.
+        libs = lambda path: inside(path, libdir) and not inside(path, os.path.join(libdir, 'python2.7'))
+        fallback = [libdir, os.path.join(stage, 'lib')]
+        needed = set()
+        queue = [f.path for f in files if f.kind == ELF and not libs(f.path) and not any(inside(f.path, e) for e in unused)]
+        queue += [f.path for f in files if f.kind == ELF and libs(f.path) and self.kept(f.path, extlib, keep)]
+        while queue:
+            path = queue.pop()
+            try:
+                with ElfFile(path) as elf:
+                    names = elf.needed()
+            except (IOError, ValueError, struct.error):
+                continue
+            for name in names:
+                found = self.resolve(path, name, fallback)
+                if found and found not in needed:
+                    needed.add(found)
+                    needed.add(os.path.realpath(found))
+                    queue.append(os.path.realpath(found))
+
+        prune = set(e for e in unused)
+        for root, dirs, names in os.walk(libdir):
+            if inside(root, os.path.join(libdir, 'python2.7')):
+                dirs[:] = []
+                continue
+            for name in names:
+                path = os.path.join(root, name)
+                if re.search(r'\.(so(\.[\d.]+)?|a|la)$', name) and path not in needed and not self.kept(path, extlib, keep):
+                    prune.add(path)
+
+        saved = 0
+        report = []
+        for path in sorted(prune):
+            if os.path.isdir(path) and not os.path.islink(path):
+                size = sum(os.lstat(os.path.join(r, i)).st_size for r, ds, ns in os.walk(path) for i in ns)
+                shutil.rmtree(path)
+            else:
+                size = os.lstat(path).st_size
+                os.unlink(path)
+            saved += size
+            report.append({'file': os.path.relpath(path, stage), 'bytes': size})
+        print("Pruned %s libraries and %s of %s site-packages entries, %.1f MB saved"%(
+            len(prune) - len(unused), len(unused), len(entries), saved/2.0**20))
+        mkdirs(self.args.cwd_images)
+        with open(os.path.join(self.args.cwd_images, 'prune.json'), 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
 # Build sub-command. Mac specific.
 class FixInstallNames(Builder):
     """Process all binary files (executables, libraries) to rename linked libraries."""
+    writes_stage = False
     
-    def find_deps(self, filename):
-        """Find linked libraries using otool -L."""
-        p = check_output(['otool','-L',filename])
-        # otool doesn't return an exit code on failure, so check..
-        if "not an object file" in p:
-            raise Exception, "Not Mach-O binary"
-        # Just get the dylib install names
-        p = [i.strip().partition(" ")[0] for i in p.split("\n")[1:]]
-        return p
-
     def id_rpath(self, filename):
         """Generate the @rpath for a file, relative to the current directory as @rpath root."""
         p = len(filename.split("/"))-1
         f = os.path.join("@loader_path", *[".."]*p)
         return f
 
+    def fix(self, f):
+        """Fix the install names and rpath of one Mach-O StageFile."""
+        # Strip the absolute path down to a relative path
+        frel = f.relpath
+        with MachOFile(f.path) as macho:
+            install_name = macho.install_name()
+            libs = macho.dylibs()
+            rpaths = macho.rpaths()
+
+        # Set the install_name.
+        install_name_id = None
+        if install_name is not None:
+            install_name_id = os.path.join('@rpath', frel)
+            if install_name_id == install_name:
+                install_name_id = None
+
+        # Set @rpath, this is a reference to the root of the package.
+        # Linked libraries will be referenced relative to this.
+        rpath = self.id_rpath(frel)
+        if rpath in rpaths:
+            rpath = None
+
+        # Process each linked library with the regexes in REPLACE.
+        changes = {}
+        for lib in libs:
+            olib = lib
+            for k,v in self.args.replace.items():
+                lib = re.sub(k, v, lib)
+            if olib != lib:
+                changes[olib] = lib
+
+        if not (install_name_id or rpath or changes):
+            return
+
+        # Rewrite the headers directly when there is room, otherwise
+        # make all the changes with a single install_name_tool call.
+        break_link(f.path)
+        try:
+            with writable(f.path), MachOFile(f.path, write=True) as macho:
+                done = macho.rewrite(install_name_id, changes, rpath)
+        except (IOError, OSError, ValueError, struct.error), e:
+            done = False
+        if not done:
+            c = ['install_name_tool']
+            if install_name_id:
+                c += ['-id', install_name_id]
+            if rpath:
+                c += ['-add_rpath', rpath]
+            for olib, lib in sorted(changes.items()):
+                c += ['-change', olib, lib]
+            with writable(f.path):
+                self.call(c + [f.path])
+
     def run(self):
         log("Fixing install_name")
-        cwd = os.getcwd()
-        os.chdir(self.args.cwd_rpath)       
- 
-        # Find all files that end in .so/.dylib, or are executable
-        # This will include many script files, but we will ignore
-        # these failures when running otool/install_name_tool
-        targets = set()
-        targets |= set(find_ext('.so', root=self.args.cwd_rpath))
-        targets |= set(find_ext('.dylib', root=self.args.cwd_rpath))
-        targets |= set(find_exec(root=self.args.cwd_rpath))
-
-        for f in sorted(targets):
-            # Get the linked libraries and
-            # check if the file is a Mach-O binary
+        executor = self.executor()
+        for f in self.index.files():
+            if f.kind == MACHO:
+                executor.submit(f.path, functools.partial(self.fix, f))
+        for path, results in executor.join():
+            self.index.refresh(path)
+        self.check(executor.failures)
+
+class StripBinaries(Builder):
+    """Strip the staged binaries, keeping their debug info in a separate archive.
+
+    ELF files are split with objcopy --only-keep-debug into
+    debug/<distname>/.build-id/ab/cdef....debug, the layout gdb and
+    other symbolizers look up by build-id, and then stripped with a
+    debuglink. Mach-O files get a dSYM bundle named by their LC_UUID
+    and are stripped with strip -S -x. Files are processed by the
+    step's executor, and the debug tree is packaged next to the image
+    as <image>.debug.tar.gz.
+    """
+    writes_stage = False
+
+    def writes(self):
+        return [self.args.cwd_stage, self.args.cwd_debug, self.args.cwd_images]
+
+    def strip_elf(self, f):
+        entry = {'file': f.relpath, 'before': f.size, 'after': f.size, 'method': 'stripped already', 'id': None}
+        with ElfFile(f.path) as elf:
+            sections = elf.sections()
+            entry['id'] = elf.build_id()
+        if not [i for i in sections if i == '.symtab' or i.startswith('.debug_')]:
+            return entry
+        if entry['id']:
+            debug = os.path.join(self.args.cwd_debug, '.build-id', entry['id'][:2], entry['id'][2:]+'.debug')
+        else:
+            debug = os.path.join(self.args.cwd_debug, 'by-path', f.relpath+'.debug')
+        mkdirs(os.path.dirname(debug))
+        entry['method'] = 'failed'
+        if self.call(['objcopy', '--only-keep-debug', f.path, debug]):
+            return entry
+        break_link(f.path)
+        with writable(f.path):
+            if self.call(['strip', '--strip-unneeded', f.path]):
+                return entry
+            if self.call(['objcopy', '--add-gnu-debuglink='+debug, f.path]):
+                return entry
+        entry.update(method='stripped', after=os.path.getsize(f.path))
+        return entry
+
+    def strip_macho(self, f):
+        entry = {'file': f.relpath, 'before': f.size, 'after': f.size, 'method': 'failed', 'id': None}
+        with MachOFile(f.path) as macho:
+            entry['id'] = macho.slices[0].uuid
+        debug = os.path.join(self.args.cwd_debug, 'dSYM', (entry['id'] or f.relpath.replace('/', '_'))+'.dSYM')
+        if entry['id'] and os.path.isdir(debug):
+            # Stripping keeps the UUID, so this file was split before.
+            entry['method'] = 'stripped already'
+            return entry
+        mkdirs(os.path.dirname(debug))
+        if self.call(['dsymutil', '-o', debug, f.path]):
+            return entry
+        break_link(f.path)
+        with writable(f.path):
+            if self.call(['strip', '-S', '-x', f.path]):
+                return entry
+        entry.update(method='stripped', after=os.path.getsize(f.path))
+        return entry
+
+    def run(self):
+        log("Stripping binaries")
+        tools = ['strip', 'dsymutil'] if self.args.target_desc == 'mac' else ['strip', 'objcopy']
+        missing = [i for i in tools if not distutils.spawn.find_executable(i)]
+        if missing:
+            print("Not stripping, %s not found"%", ".join(missing))
+            return
+        executor = self.executor()
+        for f in self.index.files():
+            if f.kind == ELF:
+                executor.submit(f.path, functools.partial(self.strip_elf, f))
+            elif f.kind == MACHO:
+                executor.submit(f.path, functools.partial(self.strip_macho, f))
+        report, failures = [], []
+        for path, results in executor.join():
+            self.index.refresh(path)
+            if results:
+                report.append(results[0])
+                if results[0]['method'] == 'failed':
+                    failures.append((path, 'strip failed'))
+        failures.extend(i for i in executor.failures if i[0] not in dict(failures))
+
+        # Debug files of binaries that are no longer in the stage.
+        ids = set(i['id'] for i in report if i['id'])
+        for path in glob.glob(os.path.join(self.args.cwd_debug, '.build-id', '*', '*.debug')):
+            if os.path.basename(os.path.dirname(path)) + os.path.basename(path)[:-6] not in ids:
+                os.unlink(path)
+
+        report.sort(key=lambda i: i['after'] - i['before'])
+        for i in report[:20]:
+            if i['after'] < i['before']:
+                print("%-60s %8.1f MB -> %8.1f MB (-%.0f%%)"%(i['file'], i['before']/2.0**20, i['after']/2.0**20, 100.0*(i['before']-i['after'])/i['before']))
+        before, after = sum(i['before'] for i in report), sum(i['after'] for i in report)
+        counts = collections.Counter(i['method'] for i in report)
+        print("%s; %.1f MB -> %.1f MB"%(", ".join("%s: %s"%(k, v) for k, v in sorted(counts.items())), before/2.0**20, after/2.0**20))
+        mkdirs(self.args.cwd_images)
+        with open(os.path.join(self.args.cwd_images, 'strip.json'), 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+        if os.path.isdir(self.args.cwd_debug):
+            image = os.path.join(self.args.cwd_images, "%s.%s.%s.debug.tar.gz"%(self.args.repository, self.args.release, self.args.target_desc))
+            write_images(self.args.cwd_debug, 'debug', [image], self.args.threads, source_date_epoch(self.args))
+        self.check(failures)
+
+# Run by the target interpreter: compile.py stage files...
+# Hash-based pycs (3.7+) stay valid wherever the install is unpacked; for
+# older versions CompilePython sets the source mtimes to the image mtime first.
+COMPILE_SCRIPT = r"""
+import sys, os, py_compile
+kwargs = {}
+if sys.version_info >= (3, 7):
+    kwargs['invalidation_mode'] = py_compile.PycInvalidationMode.CHECKED_HASH
+failed = 0
+for path in sys.argv[2:]:
+    try:
+        py_compile.compile(path, dfile=os.path.relpath(path, sys.argv[1]), doraise=True, **kwargs)
+    except py_compile.PyCompileError as e:
+        failed += 1
+        sys.stderr.write(str(e) + "\n")
+sys.exit(1 if failed else 0)
+"""
+
+# The same report as -X importtime, for interpreters older than 3.7.
+IMPORTTIME_SCRIPT = r"""
+import sys, time, imp, __builtin__
+stack, times, order = [], {}, []
+real_import = __builtin__.__import__
+def timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return real_import(name, *args, **kwargs)
+    start = time.time()
+    stack.append(0.0)
+    try:
+        return real_import(name, *args, **kwargs)
+    finally:
+        children = stack.pop()
+        total = time.time() - start
+        if stack:
+            stack[-1] += total
+        if name not in times:
+            order.append(name)
+            times[name] = (total - children, total, len(stack))
+__builtin__.__import__ = timed_import
+try:
+    imp.load_source('__profiled__', sys.argv[1])
+finally:
+    for name in order:
+        self, total, depth = times[name]
+        sys.stderr.write("import time: %d | %d | %s%s\n" % (self * 1e6, total * 1e6, "  " * depth, name))
+"""
+
+LOAD_SCRIPT = r"""
+import sys, importlib.util
+spec = importlib.util.spec_from_file_location('__profiled__', sys.argv[1])
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+"""
+
+class CompilePython(Builder):
+    """Byte-compile the staged Python, and profile the startup imports of a few entry points.
+
+    lib/, bin/ and extlib site-packages are compiled by --threads
+    batches of args.python. The import profile of each --profile-entries
+    script in bin/ is written next to the image as
+    <image>.importtime.json, and the import times go into the history
+    database, where "report" shows their trend.
+    """
+    def writes(self):
+        return [self.args.cwd_stage, self.args.cwd_images]
+
+    def trees(self):
+        stage = self.args.cwd_rpath
+        return tuple(os.path.join(stage, i) + os.sep for i in ('lib', 'bin', 'site', os.path.join('extlib', 'lib', 'python2.7', 'site-packages')))
+
+    def sources(self):
+        return [f for f in self.index.files() if f.path.endswith('.py') and f.path.startswith(self.trees())]
+
+    def compile(self, version):
+        # Python 2 rewrites an existing .pyc in place, which would write
+        # through a hardlink into extlib/<distname>; they are compiled again anyway.
+        for f in self.index.files():
+            if f.nlink > 1 and f.path.endswith(('.pyc', '.pyo')) and f.path.startswith(self.trees()):
+                os.unlink(f.path)
+                self.index.refresh(f.path)
+        sources = self.sources()
+        if version < (3, 7):
+            # The pyc records the source mtime; make it the one the image will have.
+            epoch = source_date_epoch(self.args)
+            layers = tuple(os.path.join(self.args.cwd_rpath, i) + os.sep for i in layer_dirs(self.args))
+            for f in sources:
+                mtime = LAYER_EPOCH if f.path.startswith(layers) else epoch
+                if f.mtime != mtime:
+                    if f.nlink > 1:
+                        break_link(f.path)
+                    os.utime(f.path, (mtime, mtime))
+        executor = self.executor()
+        batches = max(1, min(self.args.threads * 4, len(sources) // 50))
+        for i in range(batches):
+            batch = [f.path for f in sources[i::batches]]
+            if batch:
+                executor.submit('batch %s'%i, [self.args.python, self.scripts['compile'], self.args.cwd_rpath] + batch)
+        executor.join()
+        print("Compiled %s files with Python %s.%s"%(len(sources), version[0], version[1]))
+        return executor.failures
+
+    def profile(self, version, entry):
+        """Import one bin/ script without running it; returns the wall time and the import times."""
+        path = os.path.join(self.args.cwd_rpath, 'bin', entry)
+        stage = self.args.cwd_rpath
+        # The target's pythonpath where it has one (Mac), else the Linux layout.
+        dirs = self.args.pythonpath or ['lib', 'bin', os.path.join('extlib', 'lib', 'python2.7', 'site-packages')]
+        env = dict(os.environ, EMAN2DIR=stage, PYTHONDONTWRITEBYTECODE='1', PYTHONPATH=":".join(
+            os.path.join(stage, i) for i in dirs))
+        if version >= (3, 7):
+            args = [self.args.python, '-X', 'importtime', self.scripts['load'], path]
+        else:
+            args = [self.args.python, self.scripts['importtime'], path]
+        start = time.time()
+        p = subprocess.Popen(args, stdout=open(os.devnull, 'w'), stderr=subprocess.PIPE, env=env, cwd=stage)
+        unused, err = p.communicate()
+        wall = time.time() - start
+        modules = []
+        for m in re.finditer(r'^import time:\s*(\d+)\s*\|\s*(\d+)\s*\|( *)(\S+)', err, re.M):
+            modules.append({'module': m.group(4), 'self': int(m.group(1))/1e6, 'cumulative': int(m.group(2))/1e6, 'depth': len(m.group(3))//2})
+        return {'entry': entry, 'wall': wall, 'returncode': p.returncode, 'modules': modules,
+            'error': err.strip().split('\n')[-1] if p.returncode else None}
+
+    def run(self):
+        log("Compiling Python")
+        version = python_version(self.args.python)
+        if not version:
+            print("Not compiling, %s does not run"%self.args.python)
+            return
+        tmp = tempfile.mkdtemp()
+        try:
+            self.scripts = {}
+            for name, text in (('compile', COMPILE_SCRIPT), ('importtime', IMPORTTIME_SCRIPT), ('load', LOAD_SCRIPT)):
+                self.scripts[name] = os.path.join(tmp, name+'.py')
+                with open(self.scripts[name], 'w') as f:
+                    f.write(text)
+            failures = self.compile(version)
+            profiles = []
+            for entry in filter(None, self.args.profile_entries.split(',')):
+                if os.path.exists(os.path.join(self.args.cwd_rpath, 'bin', entry)):
+                    profiles.append(self.profile(version, entry))
+        finally:
+            shutil.rmtree(tmp)
+        if profiles:
+            log("Import times")
+            for p in profiles:
+                print("%-30s %6.2fs%s"%(p['entry'], p['wall'], "  (failed: %s)"%p['error'] if p['error'] else ""))
+                for m in sorted(p['modules'], key=lambda m: -m['self'])[:10]:
+                    print("    %-40s %6.3fs self %6.3fs cumulative"%(m['module'], m['self'], m['cumulative']))
+            mkdirs(self.args.cwd_images)
+            imgname = "%s.%s.%s.importtime.json"%(self.args.repository, self.args.release, self.args.target_desc)
+            with open(os.path.join(self.args.cwd_images, imgname), 'w') as f:
+                json.dump(profiles, f, indent=1, sort_keys=True)
+            record_steps(self.args, datetime.datetime.utcnow().isoformat(), [{'step': 'import %s'%p['entry'],
+                'status': 'failed' if p['error'] else 'ok', 'wall': p['wall'], 'user': 0, 'sys': 0, 'maxrss': 0, 'written': 0}
+                for p in profiles])
+        self.check(failures)
+
+# Layered tarballs: the image is the core EMAN2 tree followed by one
+# layer for each --layers directory (extlib by default). Each layer is
+# a tar without the end of archive marker, compressed on its own, and
+# named in cwd_layers by the hash of its contents; a layer whose
+# contents did not change is reused instead of compressed again. Only the
+# core layer has the commit time; the others have LAYER_EPOCH, which
+# CompilePython also gives their sources.
+# Concatenated compressed streams are a valid .tar.gz, .tar.zst or
+# .tar.xz, so the image is its layers followed by the end marker.
+# The layers are also published next to the image with a
+# <image>.layers.json manifest of their sizes and sha256, so the
+# installer can fetch and verify them separately; tar extracts each
+# layer on its own.
+class TarballPackage(Builder):
+    """Base of the package steps that write the EMAN2 tree as tarballs."""
+
+    def write_tarballs(self):
+        imgname = "%s.%s.%s"%(self.args.repository, self.args.release, self.args.target_desc)
+        if self.args.layers:
+            self.write_layered(imgname, self.args.formats.split(","), source_date_epoch(self.args))
+        else:
+            images = [os.path.join(self.args.cwd_images, "%s.%s"%(imgname, i)) for i in self.args.formats.split(",")]
+            write_images(self.args.cwd_rpath, 'EMAN2', images, self.args.threads, source_date_epoch(self.args))
+
+    def layers(self):
+        """(name, root, arcname, exclude) of each layer: the core EMAN2 tree, then each --layers directory."""
+        dirs = layer_dirs(self.args)
+        paths = [os.path.join(self.args.cwd_rpath, i) for i in dirs]
+        layers = [('core', self.args.cwd_rpath, 'EMAN2', set(paths))]
+        for d, path in zip(dirs, paths):
+            layers.append((d.replace('/', '-'), path, 'EMAN2/'+d, set(p for p in paths if p.startswith(path+os.sep))))
+        return layers
+
+    def layer_hash(self, root, arcname, exclude, db):
+        """Hash of the names, types, modes, links and file contents of a layer; mtimes are left out."""
+        entries = list(tar_entries(root, arcname, 0, exclude))
+        hashes = hash_files([path for info, path in entries if info.isreg() and info.size], db, self.args.threads)
+        h = hashlib.sha256()
+        for info, path in entries:
+            h.update("%s\0%s\0%o\0%s\0%s\0%s\n"%(info.name, info.type, info.mode, info.linkname, info.size, hashes.get(path, '')))
+        return h.hexdigest()
+
+    def write_layer(self, files, root, arcname, exclude, mtime):
+        """Compress a layer into each of files, and record its sizes and sha256 in <file>.json."""
+        sinks = Fanout([compressor(i, self.args.threads) for i in files])
+        try:
             try:
-                libs = self.find_deps(f)
-            except Exception, e:
-                continue
+                size = write_tar(sinks, root, arcname, mtime, eof=False, exclude=exclude)
+            finally:
+                sinks.close()
+        except:
+            for i in files:
+                if os.path.exists(i + '.tmp'):
+                    os.unlink(i + '.tmp')
+            raise
+        for i in files:
+            os.rename(i + '.tmp', i)
+            with open(i + '.json', 'w') as f:
+                json.dump({'tar_size': size, 'size': os.path.getsize(i), 'sha256': sha256_file(i)}, f)
+
+    def write_layered(self, imgname, formats, mtime):
+        mkdirs(self.args.cwd_images)
+        mkdirs(self.args.cwd_layers)
+        mkdirs(os.path.dirname(self.args.history))
+        manifest = {'image': imgname, 'layers': [], 'images': {}}
+        used = set()
+        db = history_db(self.args.history)
+        try:
+            for name, root, arcname, exclude in self.layers():
+                digest = self.layer_hash(root, arcname, exclude, db)
+                files = dict((i, os.path.join(self.args.cwd_layers, "%s.layer-%s-%s.%s"%(imgname, name, digest[:16], i))) for i in formats)
+                missing = []
+                for path in files.values():
+                    try:
+                        with open(path + '.json') as f:
+                            if json.load(f)['size'] != os.path.getsize(path):
+                                missing.append(path)
+                    except (IOError, OSError, ValueError, KeyError):
+                        missing.append(path)
+                if missing:
+                    self.write_layer(missing, root, arcname, exclude, mtime if name == 'core' else LAYER_EPOCH)
+                layer = {'name': name, 'path': arcname, 'hash': digest, 'files': {}}
+                for i, path in sorted(files.items()):
+                    with open(path + '.json') as f:
+                        info = json.load(f)
+                    layer['tar_size'] = info['tar_size']
+                    layer['files'][i] = {'file': os.path.basename(path), 'size': info['size'], 'sha256': info['sha256']}
+                    used.add(os.path.basename(path))
+                manifest['layers'].append(layer)
+                print("Layer %s %s: %s, %.0f MB"%(name, digest[:16], "written" if missing else "reused", layer['tar_size']/2.0**20))
+        finally:
+            db.close()
+
+        # End of archive marker, padded to a full record like tar(1).
+        size = sum(l['tar_size'] for l in manifest['layers'])
+        end = 2 * tarfile.BLOCKSIZE
+        end += -(size + end) % tarfile.RECORDSIZE
+        for i in formats:
+            image = os.path.join(self.args.cwd_images, "%s.%s"%(imgname, i))
+            # compressor() picks the format from the suffix.
+            eof = os.path.join(self.args.cwd_layers, "%s.eof.%s"%(imgname, i))
+            sink = compressor(eof, 1)
+            sink.write(tarfile.NUL * end)
+            sink.close()
+            h = hashlib.sha256()
+            try:
+                with open(image + '.tmp', 'wb') as out:
+                    for path in [os.path.join(self.args.cwd_layers, l['files'][i]['file']) for l in manifest['layers']] + [eof + '.tmp']:
+                        with open(path, 'rb') as f:
+                            for chunk in iter(lambda: f.read(1<<20), ''):
+                                h.update(chunk)
+                                out.write(chunk)
+            except:
+                if os.path.exists(image + '.tmp'):
+                    os.unlink(image + '.tmp')
+                raise
+            finally:
+                os.unlink(eof + '.tmp')
+            os.rename(image + '.tmp', image)
+            manifest['images'][i] = {'file': os.path.basename(image), 'size': os.path.getsize(image), 'sha256': h.hexdigest()}
+            print("%s: %.0f MB from %.0f MB"%(os.path.basename(image), os.path.getsize(image)/2.0**20, (size+end)/2.0**20))
+
+        # Publish the layers next to the image, and remove the ones it no longer uses.
+        prefix = imgname + '.layer-'
+        for d in (self.args.cwd_images, self.args.cwd_layers):
+            for name in os.listdir(d):
+                if name.startswith(prefix) and re.sub(r'\.json$', '', name) not in used:
+                    os.unlink(os.path.join(d, name))
+        for name in sorted(used):
+            published = os.path.join(self.args.cwd_images, name)
+            if os.path.exists(published):
+                os.unlink(published)
+            try:
+                os.link(os.path.join(self.args.cwd_layers, name), published)
+            except OSError:
+                shutil.copy2(os.path.join(self.args.cwd_layers, name), published)
+        with open(os.path.join(self.args.cwd_images, imgname + '.layers.json'), 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
 
-            # print f
-            # Strip the absolute path down to a relative path
-            frel = f.replace(self.args.cwd_rpath, "")[1:]
+class UnixPackage(TarballPackage):
+    def writes(self):
+        return [self.args.cwd_stage, self.args.cwd_images]
 
-            # Set the install_name.
-            install_name_id = os.path.join('@rpath', frel)
-            # print "\tsetting id:", install_name_id
-            cmd(['install_name_tool', '-id', install_name_id, f])
-
-            # Set @rpath, this is a reference to the root of the package.
-            # Linked libraries will be referenced relative to this.
-            rpath = self.id_rpath(frel)
-            # print "\tadding @rpath:", rpath
-            try: cmd(['install_name_tool', '-add_rpath', rpath, f])
-            except: pass
-
-            # Process each linked library with the regexes in REPLACE.
-            for lib in libs:
-                olib = lib
-                for k,v in self.args.replace.items():
-                    lib = re.sub(k, v, lib)
-                if olib != lib:
-                    # print "\t", olib, "->", lib
-                    try: cmd(['install_name_tool', '-change', olib, lib, f])
-                    except: pass
-
-class UnixPackage(Builder):
     def run(self):
         log("Building tarball")
         mkdirs(os.path.join(self.args.cwd_images))
@@ -509,21 +3346,64 @@ class UnixPackage(Builder):
         with open(os.path.join(self.args.cwd_rpath, 'build_date.'+now), 'w') as f:
             f.write("EMAN2 %s built on %s."%(self.args.cvstag, now))
 
-        imgname = "%s.%s.%s.tar.gz"%(self.args.repository, self.args.release, self.args.target_desc)
-        img = os.path.join(self.args.cwd_images, imgname)
-        hdi = ['tar', '-czf', img, 'EMAN2']
-        cmd(hdi, cwd=self.args.cwd_stage)
+        self.write_tarballs()
+
+class StoreImages(Builder):
+    """Add the packaged images to the image store, then apply retention and collect garbage."""
+    writes_stage = False
+
+    def reads(self):
+        return [self.args.cwd_images]
+
+    def writes(self):
+        return [self.args.cwd_store]
+
+    def run(self):
+        if not self.args.store:
+            return
+        log("Storing images")
+        store = ImageStore(self.args.cwd_store)
+        prefix = "%s.%s.%s."%(self.args.repository, self.args.release, self.args.target_desc)
+        for name in sorted(os.listdir(self.args.cwd_images)):
+            # Layers are stored as part of their image.
+            if name.startswith(prefix) and name.endswith(IMAGE_SUFFIXES) and not name.startswith(prefix + 'layer-'):
+                manifest, added = store.add(os.path.join(self.args.cwd_images, name), self.args.commit, self.args.release)
+                print("%s: %.1f MB new in the store for a %.1f MB image"%(name, added/2.0**20, manifest['size']/2.0**20))
+        removed = store.retain(self.args.keep_nightlies)
+        freed = store.gc()
+        used, total = store.usage()
+        print("Removed %s old nightlies, freed %.1f MB; %.1f MB stored for %.1f MB of images"%(
+            removed, freed/2.0**20, used/2.0**20, total/2.0**20))
 
 class UnixUpload(Builder):
+    writes_stage = False
+
+    def reads(self):
+        return [self.args.cwd_images]
+
+    def writes(self):
+        return []
+
     def run(self):
         log("Uploading archive")
-        imgname = "%s.%s.%s.tar.gz"%(self.args.repository, self.args.release, self.args.target_desc)
-        img = os.path.join(self.args.cwd_images, imgname)
-        scpdest = "%s@%s:%s/%s"%(self.args.scpuser, self.args.scphost, self.args.scpdest, imgname)
-        scp = ['scp', img, scpdest]
-        cmd(scp)
+        transport = upload_transport(self.args)
+        for i in self.args.formats.split(","):
+            imgname = "%s.%s.%s.%s"%(self.args.repository, self.args.release, self.args.target_desc, i)
+            upload(os.path.join(self.args.cwd_images, imgname), transport, self.args.threads)
+        # The layers of a layered image, then the manifest that lists them.
+        manifest = os.path.join(self.args.cwd_images, "%s.%s.%s.layers.json"%(self.args.repository, self.args.release, self.args.target_desc))
+        if self.args.layers and os.path.exists(manifest):
+            with open(manifest) as f:
+                layers = json.load(f)['layers']
+            for layer in layers:
+                for i in self.args.formats.split(","):
+                    upload(os.path.join(self.args.cwd_images, layer['files'][i]['file']), transport, self.args.threads)
+            upload(manifest, transport, self.args.threads)
     
-class MacPackage(Builder):
+class MacPackage(TarballPackage):
+    def writes(self):
+        return [self.args.cwd_stage, self.args.cwd_images]
+
     def run(self):
         log("Building disk image")
         mkdirs(os.path.join(self.args.cwd_images))
@@ -542,48 +3422,432 @@ class MacPackage(Builder):
         hdi = ['hdiutil', 'create', '-ov', '-srcfolder', self.args.cwd_stage, '-volname', volname, img]
         cmd(hdi)
 
+        # Tarballs of the same tree, for installs that do not use the disk image.
+        self.write_tarballs()
+
 class MacUpload(Builder):
+    writes_stage = False
+
+    def reads(self):
+        return [self.args.cwd_images]
+
+    def writes(self):
+        return []
+
     def run(self):
         log("Uploading disk image")
         imgname = "%s.%s.%s.dmg"%(self.args.repository, self.args.release, self.args.target_desc)
-        img = os.path.join(self.args.cwd_images, imgname)
-        scpdest = "%s@%s:%s/%s"%(self.args.scpuser, self.args.scphost, self.args.scpdest, imgname)
-        scp = ['scp', img, scpdest]
-        cmd(scp)
-
-if __name__ == "__main__":
-
-    commit = check_output(['git ls-remote git@github.com:cryoem/eman2.git | grep HEAD | cut -f 1'],shell=True)
+        upload(os.path.join(self.args.cwd_images, imgname), upload_transport(self.args), self.args.threads)
+
+##### Build service #####
+
+# "build.py serve" runs a long-lived service on a Unix socket. Clients
+# send one JSON request per connection and get one JSON reply:
+#   {"op": "submit", "argv": [build.py arguments]}
+#   {"op": "submit", "exec": [command], "key": ..., "lock": ...}
+#   {"op": "status"}
+# A request for a build that is already queued or running is coalesced
+# with it. Builds that share a root run one at a time; builds on
+# different roots run in parallel, up to --service-jobs.
+
+DEFAULT_SOCKET = os.environ.get('EMAN2_BUILD_SOCKET', os.path.join(tempfile.gettempdir(), 'eman2-build.sock'))
+
+class BuildService(object):
+    """Queue of build jobs, run as child processes."""
+
+    def __init__(self, jobs, logdir, history=100):
+        self.logdir = logdir
+        self.history = history
+        self.cond = threading.Condition()
+        self.jobs = collections.OrderedDict()
+        self.busy = set()
+        self.count = 0
+        mkdirs(logdir)
+        for i in range(jobs):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+
+    def handle(self, request):
+        if request.get('op') == 'submit':
+            return self.submit(request)
+        elif request.get('op') == 'status':
+            return self.status()
+        raise ValueError("Unknown request: %s"%request.get('op'))
+
+    def submit(self, request):
+        if request.get('exec'):
+            command = list(request['exec'])
+            key = request.get('key') or " ".join(command)
+            lock = request.get('lock') or key
+        else:
+            # Resolve the commit now, so duplicates of the same build are recognized.
+            argv = list(request['argv'])
+            try:
+                args = resolve_commit(arguments().parse_args(argv))
+            except SystemExit:
+                raise ValueError("Invalid build.py arguments: %s"%" ".join(argv))
+            if '--commit' not in argv:
+                argv += ['--commit', args.commit]
+            command = [sys.executable, os.path.abspath(__file__).replace('.pyc', '.py')] + argv
+            key = json.dumps([os.path.abspath(args.root), args.target, args.release, args.commit, args.commands])
+            lock = os.path.abspath(args.root)
+        with self.cond:
+            for job in self.jobs.values():
+                if job['key'] == key and job['state'] in ('queued', 'running'):
+                    return dict(job, coalesced=True)
+            self.count += 1
+            job = {'id': self.count, 'key': key, 'lock': lock, 'command': command, 'state': 'queued',
+                'submitted': time.time(), 'started': None, 'finished': None, 'returncode': None,
+                'step': None, 'last': None, 'log': os.path.join(self.logdir, '%s.log'%self.count)}
+            self.jobs[job['id']] = job
+            # Forget the oldest finished jobs.
+            done = [i for i, j in self.jobs.items() if j['state'] in ('done', 'failed')]
+            for i in done[:max(0, len(done) - self.history)]:
+                del self.jobs[i]
+            self.cond.notify_all()
+            return dict(job, coalesced=False)
+
+    def status(self):
+        with self.cond:
+            jobs = [dict(j) for j in self.jobs.values()]
+        now = time.time()
+        for j in jobs:
+            j['elapsed'] = now - (j['started'] or now) if not j['finished'] else j['finished'] - j['started']
+        return {'queued': len([j for j in jobs if j['state'] == 'queued']),
+                'running': len([j for j in jobs if j['state'] == 'running']), 'jobs': jobs}
+
+    def worker(self):
+        while True:
+            with self.cond:
+                job = None
+                while not job:
+                    job = next((j for j in self.jobs.values() if j['state'] == 'queued' and j['lock'] not in self.busy), None)
+                    if not job:
+                        self.cond.wait()
+                job['state'] = 'running'
+                job['started'] = time.time()
+                self.busy.add(job['lock'])
+            try:
+                job['returncode'] = self.execute(job)
+            except Exception, e:
+                job['last'] = str(e)
+                job['returncode'] = -1
+            with self.cond:
+                job['finished'] = time.time()
+                job['state'] = 'done' if job['returncode'] == 0 else 'failed'
+                self.busy.discard(job['lock'])
+                self.cond.notify_all()
+
+    def execute(self, job):
+        """Run a job, logging its output and keeping its latest step and line as progress."""
+        env = dict(os.environ, EMAN2_BUILD_JOB=str(job['id']))
+        with open(job['log'], 'w') as logfile:
+            p = subprocess.Popen(job['command'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+            for line in iter(p.stdout.readline, ''):
+                logfile.write(line)
+                logfile.flush()
+                line = line.strip()
+                if line.startswith('=====') and line.endswith('====='):
+                    job['step'] = line.strip('= ')
+                if line:
+                    job['last'] = line[:200]
+            return p.wait()
+
+class ServiceServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class ServiceHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            reply = self.server.service.handle(json.loads(self.rfile.readline()))
+        except Exception, e:
+            reply = {'error': str(e)}
+        self.wfile.write(json.dumps(reply) + '\n')
+
+def service_request(path, request):
+    """Send one request to the build service; returns its reply."""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        s.sendall(json.dumps(request) + '\n')
+        reply = json.loads(s.makefile().readline())
+    finally:
+        s.close()
+    if 'error' in reply:
+        raise Exception, reply['error']
+    return reply
+
+def serve(path, jobs, logdir):
+    if os.path.exists(path):
+        try:
+            service_request(path, {'op': 'status'})
+            raise Exception, "A build service is already listening on %s"%path
+        except socket.error:
+            os.unlink(path)
+    server = ServiceServer(path, ServiceHandler)
+    server.service = BuildService(jobs, logdir)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log("Build service listening on %s, %s jobs, logs in %s"%(path, jobs, logdir))
+    try:
+        server.serve_forever()
+    finally:
+        os.unlink(path)
+
+def print_status(status):
+    print("%s queued, %s running"%(status['queued'], status['running']))
+    for j in status['jobs']:
+        print("%4s %-8s %6.0fs  %-30s %s"%(j['id'], j['state'], j['elapsed'], (j['step'] or '')[:30], j['last'] or ''))
+        print("     %s"%" ".join(j['command']))
+
+def service_main(argv):
+    """build.py serve|submit|status; submit takes the job after --"""
+    parser = argparse.ArgumentParser(prog='build.py')
+    parser.add_argument('op',       choices=['serve', 'submit', 'status'])
+    parser.add_argument('--socket', help='Unix socket of the build service; $EMAN2_BUILD_SOCKET', default=DEFAULT_SOCKET)
+    parser.add_argument('--service-jobs', help='Serve: builds to run at the same time, on different roots', type=int, default=2)
+    parser.add_argument('--log-dir', help='Serve: directory for job logs', default=os.path.join(tempfile.gettempdir(), 'eman2-build-jobs'))
+    parser.add_argument('--exec',   help='Submit: the arguments are a command to run, not build.py arguments', action='store_true', dest='execute')
+    parser.add_argument('--key',    help='Submit --exec: jobs with the same key are coalesced', default=None)
+    parser.add_argument('--lock',   help='Submit --exec: jobs with the same lock run one at a time', default=None)
+    parser.add_argument('--wait',   help='Submit: wait for the job and exit with its status', action='store_true')
+    # Everything after -- is the job: build.py arguments, or the --exec command.
+    job = []
+    if '--' in argv:
+        job = argv[argv.index('--')+1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    argv = job
+
+    if args.op == 'serve':
+        serve(args.socket, args.service_jobs, args.log_dir)
+    elif args.op == 'status':
+        print_status(service_request(args.socket, {'op': 'status'}))
+    else:
+        if args.execute:
+            request = {'op': 'submit', 'exec': argv, 'key': args.key, 'lock': args.lock}
+        else:
+            request = {'op': 'submit', 'argv': argv}
+        job = service_request(args.socket, request)
+        print("Job %s %s%s: %s"%(job['id'], job['state'], " (coalesced)" if job['coalesced'] else "", job['log']))
+        while args.wait and job['state'] in ('queued', 'running'):
+            time.sleep(5)
+            job = [j for j in service_request(args.socket, {'op': 'status'})['jobs'] if j['id'] == job['id']][0]
+        if args.wait:
+            print("Job %s %s: %s"%(job['id'], job['state'], job['log']))
+            sys.exit(0 if job['state'] == 'done' else 1)
+
+##### Matrix builds #####
+
+def mem_available():
+    """Bytes of available memory, or None where /proc/meminfo is missing."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+class Jobserver(object):
+    """A GNU make jobserver shared by several builds.
+
+    Each top level make has one implicit job slot, so the pipe holds
+    cpus minus the number of builds tokens. A governor thread takes
+    tokens out of circulation while free memory is low or the load is
+    too high, and puts them back when the machine recovers.
+    """
 
+    def __init__(self, tokens):
+        self.r, self.w = os.pipe()
+        self.tokens = tokens
+        self.held = 0
+        os.write(self.w, '+' * tokens)
+
+    def makeflags(self):
+        return ' -j --jobserver-fds=%s,%s'%(self.r, self.w)
+
+    def govern(self, min_free, max_load, interval=5):
+        while True:
+            free = mem_available()
+            overloaded = (free is not None and free < min_free) or os.getloadavg()[0] > max_load
+            if overloaded and self.held < self.tokens:
+                # Blocks until a make returns a token.
+                os.read(self.r, 1)
+                self.held += 1
+                print("Matrix: holding %s of %s job tokens (load %.1f, %s MB free)"%(
+                    self.held, self.tokens, os.getloadavg()[0], free//2**20 if free is not None else '?'))
+                continue
+            elif not overloaded and self.held:
+                os.write(self.w, '+')
+                self.held -= 1
+            time.sleep(interval)
+
+def matrix_pairs(spec, root):
+    """Parse target:release[:root],... into (target, release, root) tuples."""
+    pairs = []
+    for item in filter(None, spec.split(',')):
+        parts = item.split(':')
+        if len(parts) not in (2, 3) or parts[0] not in TARGETS:
+            raise ValueError("Matrix entries are target:release[:root], with target one of %s: %s"%(", ".join(sorted(TARGETS)), item))
+        pairs.append((parts[0], parts[1], os.path.abspath(parts[2] if len(parts) == 3 else root)))
+    # Builds only share a root when their releases differ; the trees below it
+    # are per release, and the git mirror and history database they share are
+    # used under locks (see Checkout and history_db).
+    seen = {}
+    for target, release, r in pairs:
+        if (release, r) in seen:
+            raise ValueError("%s:%s and %s:%s would share %s; give one of them its own root"%(
+                seen[release, r], release, target, release, r))
+        seen[release, r] = target
+    return pairs
+
+def matrix_argv(argv):
+    """The command line without --matrix, for the builds of a matrix."""
+    out, skip = [], False
+    for i in argv:
+        if skip:
+            skip = False
+        elif i == '--matrix':
+            skip = True
+        elif not i.startswith('--matrix='):
+            out.append(i)
+    return out
+
+def matrix(args, argv):
+    """Run one build.py per target:release pair, sharing a CPU and memory budget."""
+    pairs = matrix_pairs(args.matrix, args.root)
+    jobserver = Jobserver(max(0, args.cpus - len(pairs)))
+    env = dict(os.environ, MAKEFLAGS=jobserver.makeflags())
+    governor = threading.Thread(target=jobserver.govern, args=(args.min_free_mb << 20, args.max_load or 1.5 * args.cpus))
+    governor.daemon = True
+    governor.start()
+    log("Matrix: %s builds sharing %s CPUs"%(len(pairs), args.cpus))
+
+    def build(pair):
+        target, release, root = pair
+        name = '%s:%s'%(target, release)
+        mkdirs(os.path.join(root, 'logs'))
+        logname = os.path.join(root, 'logs', 'matrix.%s.%s.log'%(target, release))
+        command = [sys.executable, os.path.abspath(__file__).replace('.pyc', '.py')] + matrix_argv(argv) + [
+            '--target', target, '--release', release, '--root', root]
+        start = time.time()
+        with open(logname, 'w') as logfile:
+            # close_fds is off, so the jobserver pipe is inherited.
+            p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+            for line in iter(p.stdout.readline, ''):
+                logfile.write(line)
+                sys.stdout.write('[%s] %s'%(name, line))
+            exitcode = p.wait()
+        return pair, exitcode, time.time() - start, logname
+
+    pool = ThreadPool(len(pairs))
+    try:
+        results = pool.map(build, pairs)
+    finally:
+        pool.close()
+
+    log("Matrix summary")
+    failed = 0
+    for (target, release, root), exitcode, wall, logname in results:
+        failed += bool(exitcode)
+        report = os.path.join(root, 'images', '%s.%s'%(args.repository, release),
+            '%s.%s.%s.report.json'%(args.repository, release, TARGETS[target].target_desc))
+        steps = ""
+        try:
+            with open(report) as f:
+                steps = ", ".join("%s %.0fs"%(m['step'], m['wall']) for m in json.load(f)['steps'])
+        except (IOError, ValueError):
+            pass
+        print("%-10s %-10s %-6s %6.0fs  %s"%(target, release, 'ok' if not exitcode else 'FAILED', wall, steps))
+        if exitcode:
+            print("           see %s"%logname)
+    return failed
+
+##### Command line #####
+
+TARGETS = {'linux64': Linux64Target, 'linux32': LinuxTarget, 'osx64': MacTarget}
+
+def platform_name():
     if "linux" in platform.platform().lower():
-        if "64" in platform.processor(): pform = 'linux64'
-        else: pform = 'linux32'
-    elif "darwin" in platform.platform().lower(): pform = 'osx64'
+        if "64" in platform.processor(): return 'linux64'
+        else: return 'linux32'
+    elif "darwin" in platform.platform().lower(): return 'osx64'
     else:
         print("No support for windows (yet?).")
         sys.exit(1)
 
+def arguments():
+    """The build.py command line parser."""
+    pform = platform_name()
     parser = argparse.ArgumentParser()
     parser.add_argument('commands',    help='Build commands', nargs='+')
-    parser.add_argument('--commit',help='git repository name', default=commit[:7])
+    parser.add_argument('--commit',help='git repository name', default=None)
+    parser.add_argument('--remote',    help='Checkout: git repository to mirror, e.g. a local bare repository', default='git@github.com:cryoem/eman2.git')
+    parser.add_argument('--ref',       help='Checkout: branch, tag or commit to check out', default='HEAD')
     parser.add_argument('--root',      help='Build system root', default='/home/eman2/build')
     parser.add_argument('--clean',     help='Make clean', type=int, default=1)
-    parser.add_argument('--target', help='platform',default=pform)
+    parser.add_argument('--incremental', help='Build: keep the build directory and stage, and only reconfigure when cmake inputs change', type=int, default=0)
+    parser.add_argument('--ccache',    help='Build: compile through ccache when it is installed', type=int, default=1)
+    parser.add_argument('--target', help='platform', choices=sorted(TARGETS), default=pform)
+    parser.add_argument('--matrix',    help='Build comma separated target:release[:root] pairs side by side, e.g. linux64:daily,linux64:2.2', default=None)
+    parser.add_argument('--cpus',      help='Matrix: job slots shared by all the builds', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--min-free-mb', help='Matrix: withhold job slots while less memory than this is available', type=int, default=2048)
+    parser.add_argument('--max-load',  help='Matrix: withhold job slots while the load average is above this; default 1.5 x --cpus', type=float, default=None)
     parser.add_argument('--repository',   help='git repository name', default="eman2")
     parser.add_argument('--release',   help='Release', default='daily')
-    parser.add_argument('--threads',   help='Threads for eman2 build parallelism', default=4)
+    parser.add_argument('--threads',   help='Threads for eman2 build parallelism', type=int, default=4)
+    parser.add_argument('--strict',    help='Fail a step when any of its per-file commands fail', type=int, default=0)
+    parser.add_argument('--extlib-copy', help='How to stage extlib: reflink, hardlink or copy; auto tries them in that order', choices=['auto', 'reflink', 'hardlink', 'copy'], default='auto')
+    parser.add_argument('--prune',     help='Install: remove extlib libraries and site-packages that EMAN2 does not load (Linux)', type=int, default=0)
+    parser.add_argument('--prune-keep', help='Install: comma separated patterns, relative to extlib, that --prune keeps', default='')
+    parser.add_argument('--strip',     help='Package: strip binaries first, keeping debug info in <image>.debug.tar.gz', type=int, default=1)
+    parser.add_argument('--compile',   help='Package: byte-compile the staged Python first', type=int, default=1)
+    parser.add_argument('--profile-entries', help='Package: comma separated bin/ scripts whose import times are profiled', default='e2version.py,e2proc2d.py,e2proc3d.py,e2display.py')
+    parser.add_argument('--import-index', help='Install: write site/modules.idx, so Python 2 finds EMAN2 modules without searching sys.path', type=int, default=1)
+    parser.add_argument('--site-benchmark', help='Install: time this many startups with PYTHONPATH and with site/; 0 to skip', type=int, default=5)
+    parser.add_argument('--formats',   help='Package: comma separated image formats, from tar.gz, tar.zst and tar.xz', default='tar.gz')
+    parser.add_argument('--force',     help='Build and package even if the ledger has an image of this commit built from the same inputs', type=int, default=0)
+    parser.add_argument('--parallel-steps', help='Run independent steps of a command concurrently', type=int, default=1)
+    parser.add_argument('--history-size', help='Report: number of builds to show', type=int, default=10)
+    parser.add_argument('--regression', help='Report: flag steps slower than the median by this fraction', type=float, default=0.25)
+    parser.add_argument('--store',     help='Package: keep every image in the deduplicating store in <root>/store', type=int, default=1)
+    parser.add_argument('--layers',    help='Package: comma separated directories of EMAN2 packaged as separate layers, reused while unchanged; empty for a single tarball', default='extlib')
+    parser.add_argument('--keep-nightlies', help='Package: nightly images to keep in the store; other releases are all kept', type=int, default=14)
+    parser.add_argument('--image',     help='Restore: image file name, by default the first image of this target')
+    parser.add_argument('--restore-commit', help='Restore: commit to restore, by default the newest', default=None)
+    parser.add_argument('--output',    help='Restore: output file, by default in the images directory', default=None)
     parser.add_argument('--scpuser',   help='Upload: scp user', default='zope')
     parser.add_argument('--scphost',   help='Upload: scp host', default='ncmi.grid.bcm.edu')
     parser.add_argument('--scpdest',   help='Upload: scp destination directory', default='/home/zope-extdata/reposit/ncmi/software/counter_222/software_86')
-    
+    parser.add_argument('--upload-dir', help='Upload: copy into this local directory instead of the scp host', default=None)
+    parser.add_argument('--upload-grace-days', help='Prune_uploads: keep unused uploaded chunks younger than this', type=float, default=7)
+    return parser
+
+def resolve_commit(args):
+    """Set args.commit to the commit --ref points to on --remote, unless it was given."""
+    if not args.commit:
+        heads = check_output(['git', 'ls-remote', args.remote, args.ref]).split()
+        args.commit = (heads[0] if heads else args.ref)[:7]
+    return args
+
+if __name__ == "__main__":
+
+    if sys.argv[1:2] in (['serve'], ['submit'], ['status']):
+        service_main(sys.argv[1:])
+        sys.exit(0)
+
+    parser = arguments()
     args = parser.parse_args()
+    if args.matrix:
+        sys.exit(1 if matrix(args, sys.argv[1:]) else 0)
+    args = resolve_commit(args)
     args.cvstag = '2.2' # need to update to git tag (2.2 release, etc)
 
-    if pform == 'linux64': target = Linux64Target(args)
-    elif pform == 'linux32': target = LinuxTarget(args)
-    elif pform == 'osx64': target = MacTarget(args)
+    target = TARGETS[args.target](args)
 
-    print("EMAN2 Nightly Build -- Commit: %s -- Target: %s -- Date: %s"%(args.commit, pform, datetime.datetime.utcnow().isoformat()))
+    print("EMAN2 Nightly Build -- Commit: %s -- Target: %s -- Date: %s"%(args.commit, args.target, datetime.datetime.utcnow().isoformat()))
 
     # git_pull("{}/co/eman2".format(args.root))
 
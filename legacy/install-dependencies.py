@@ -13,7 +13,21 @@
 # 
 # Manually before running this script
 
-from urllib import urlopen
+import os
+import urllib2
+import hashlib
+import threading
+import argparse
+import time
+import Queue
+import json
+import shutil
+import tarfile
+import platform
+import fcntl
+import contextlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from os import *
 
 OS = "LINUX"
@@ -44,12 +58,40 @@ if OS == "LINUX":
 elif OS == "MAC":
 	ftg["pyqt"] = "http://www.riverbankcomputing.co.uk/static/Downloads/PyQt4/PyQt-mac-gpl-4.6.tar.gz"
 
+# SHA-256 of each file in ftg, by file name. Every download is verified.
+# An entry without a hash is trusted on first use: the hash of the first
+# download is recorded next to it in the source directory as <file>.sha256,
+# and later downloads must match that. After changing a URL, run with --pin
+# on a host that can reach it and paste the printed lines here.
+ftg_sha256={
+"ez_setup.py":None,
+"jpegsrc.v6b.tar.gz":None,
+"gnupg-1.4.9.tar.bz2":None,
+"sip-4.9.tar.gz":None,
+"fftw-3.3.3.tar.gz":None,
+"gsl-1.12.tar.gz":None,
+"boost-jam-3.1.18.tgz":None,
+"boost_1_54_0.tar.bz2":None,
+"cmake-2.6.4.tar.gz":None,
+"hdf5-1.8.11.tar.gz":None,
+"tiff-3.8.2.tar.gz":None,
+"PyOpenGL-3.0.0.tar.gz":None,
+"PyQt-x11-gpl-4.6.tar.gz":None,
+"PyQt-mac-gpl-4.6.tar.gz":None,
+}
 
-from sys import argv
-if len(argv)<2 : 
-	print """Please specify an installation prefix location. On a mac, /usr/local is good (assuming
-you have administrative permissions. If you lack root access, use your home directory."""
-prefix=argv[1]
+parser = argparse.ArgumentParser(description="""Install the EMAN2 dependencies from source into an installation prefix.
+On a mac, /usr/local is good (assuming you have administrative permissions.
+If you lack root access, use your home directory.""")
+parser.add_argument("prefix", help="Installation prefix")
+parser.add_argument("--mirror", help="Directory or URL to fetch the source tarballs from before trying the upstream URLs, e.g. file:///srv/mirror")
+parser.add_argument("--jobs", help="Concurrent downloads", type=int, default=4)
+parser.add_argument("--cpus", help="Jobs shared by all the concurrent builds", type=int, default=multiprocessing.cpu_count())
+parser.add_argument("--cache", help="Directory of prebuilt package archives; empty to disable", default=getenv("HOME")+"/EMAN2/cache")
+parser.add_argument("--cache-size", help="Maximum size of the cache in GB", type=float, default=20)
+parser.add_argument("--pin", help="Download without verifying, print the SHA-256 lines for ftg_sha256 and exit", action="store_true")
+args = parser.parse_args()
+prefix=args.prefix
 
 fsp={}
 for i in ftg: fsp[i]=ftg[i].split("/")[-1]
@@ -62,88 +104,326 @@ except: pass
 chdir(path)
 print "Running in ",path
 
-for i in ftg:
-	if not access(fsp[i],R_OK) : 
-		print "Retrieving ",i
-		file(fsp[i],"w").write(urlopen(ftg[i]).read())
-	else: print "Already have ",i
+output_lock=threading.Lock()
+def say(*msg):
+	with output_lock: print " ".join(str(i) for i in msg)
+
+def sha256sum(filename):
+	h=hashlib.sha256()
+	f=file(filename,"rb")
+	for chunk in iter(lambda: f.read(1<<20), ""): h.update(chunk)
+	f.close()
+	return h.hexdigest()
+
+def verify(name,filename):
+	"""Check a file against the pinned SHA-256 of ftg entry name, or the one
+	recorded on its first download. With --pin, anything passes."""
+	if args.pin: return True
+	digest=sha256sum(filename)
+	expected=ftg_sha256.get(fsp[name])
+	if not expected:
+		try: expected=file(fsp[name]+".sha256").read().strip()
+		except IOError:
+			say("Warning: no SHA-256 pinned for",fsp[name],"- trusting this copy and recording",digest)
+			out=file(fsp[name]+".sha256","w")
+			out.write(digest+"\n")
+			out.close()
+			return True
+	return digest==expected
+
+def urls(name):
+	"""The mirror location of an ftg entry, if any, then its upstream URL."""
+	if args.mirror:
+		if "://" in args.mirror: yield args.mirror.rstrip("/")+"/"+fsp[name]
+		else: yield "file://"+os.path.join(os.path.abspath(args.mirror),fsp[name])
+	yield ftg[name]
+
+def fetch(url,part):
+	"""Stream url to part in chunks, resuming from the end of part with an HTTP Range request."""
+	have=0
+	if access(part,F_OK): have=stat(part).st_size
+	req=urllib2.Request(url)
+	if have: req.add_header("Range","bytes=%d-"%have)
+	resp=urllib2.urlopen(req,timeout=60)
+	# Servers that ignore Range (and ftp:// or file:// URLs) send the whole file again
+	if have and resp.getcode()!=206: have=0
+	out=file(part,"ab" if have else "wb")
+	try:
+		for chunk in iter(lambda: resp.read(1<<20), ""): out.write(chunk)
+	finally:
+		out.close()
+		resp.close()
+
+def download(name):
+	"""Retrieve one ftg entry into the source directory. Returns None on success, or an error message."""
+	if access(fsp[name],R_OK):
+		if verify(name,fsp[name]):
+			say("Already have ",name)
+			return None
+		say("Checksum mismatch, retrieving again ",name)
+		unlink(fsp[name])
+	part=fsp[name]+".part"
+	error="no source"
+	for url in urls(name):
+		say("Retrieving ",name,"from",url)
+		try: fetch(url,part)
+		except (IOError,urllib2.URLError),e:
+			# Keep the partial file; the next attempt resumes it
+			error="%s: %s"%(url,e)
+			continue
+		if verify(name,part):
+			rename(part,fsp[name])
+			return None
+		error="%s: checksum mismatch"%url
+		unlink(part)
+	return error
+
+unpinned=sorted(i for i in ftg if not ftg_sha256.get(fsp[i]))
+if unpinned and not args.pin:
+	print "Warning: no SHA-256 in ftg_sha256 for:"," ".join(fsp[i] for i in unpinned)
+	print "These are trusted on first download; run with --pin to print the lines to pin them"
+
+pool=ThreadPool(args.jobs)
+errors=[(i,e) for i,e in zip(sorted(ftg),pool.map(download,sorted(ftg))) if e]
+pool.close()
+for i,e in errors: print "Failed to retrieve ",i,e
+if errors: raise SystemExit(1)
+if args.pin:
+	for i in sorted(ftg): print '"%s":"%s",'%(fsp[i],sha256sum(fsp[i]))
+	raise SystemExit(0)
+
+# Each dependency is declared with the packages it needs, a probe that tells
+# whether it is already installed, and the shell commands that build it.
+# Independent packages are built concurrently; all their makes share one
+# jobserver, so together they never run more than --cpus jobs.
+# Packages whose "make install" honors DESTDIR can be cached: their install
+# is archived once, and restored into new prefixes instead of being rebuilt.
+pkgs={}
+def package(name,deps,installed,build,cache=False):
+	pkgs[name]=(deps,installed,build,cache)
+
+def have_file(filename): return lambda: access(filename,R_OK)
+def have_command(command): return lambda: not system("which %s > /dev/null 2>&1"%command)
+def have_module(module):
+	def probe():
+		try: __import__(module)
+		except: return False
+		return True
+	return probe
 
 # easy setup
-if system("which ipython") :
-	system("python ez_setup.py")
-	system("easy_install ipython")
-	
+package("setup",[],have_command("ipython"),
+	"python ez_setup.py; easy_install ipython")
+
 # fftw
-if not access("%s/lib/libfftw3f.3.%s"%(prefix, DLIB_FILE_EXT), R_OK) :
-	system("tar xvzf "+fsp["fftw"])
-	system("cd %s; ./configure --enable-float --enable-shared --prefix=%s; make; make install"%(fsp["fftw"][:-7],prefix))
+package("fftw",[],have_file("%s/lib/libfftw3f.3.%s"%(prefix, DLIB_FILE_EXT)),
+	"tar xvzf %s; cd %s; ./configure --enable-float --enable-shared --prefix=%s; make; make install"%(fsp["fftw"],fsp["fftw"][:-7],prefix),cache=True)
 
 # GSL
-if not access("%s/lib/libgsl.%s"%(prefix, DLIB_FILE_EXT), R_OK):
-	system("tar xvzf "+fsp["gsl"])
-	system("cd %s; ./configure --prefix=%s; make; make install"%(fsp["gsl"][:-7],prefix))
+package("gsl",[],have_file("%s/lib/libgsl.%s"%(prefix, DLIB_FILE_EXT)),
+	"tar xvzf %s; cd %s; ./configure --prefix=%s; make; make install"%(fsp["gsl"],fsp["gsl"][:-7],prefix),cache=True)
 
 # jpg
-if not access("%s/lib/libjpeg.a"%prefix,R_OK):
-	system("tar xvzf "+fsp["jpeg"])
-	system("cd jpeg-6b; cp /usr/share/libtool/config.sub .; cp /usr/share/libtool/config.guess .; ./configure --enable-shared --enable-static --prefix=%s; make; make install;ranlib %s/lib/libjpeg.a"%(prefix,prefix))
+package("jpeg",[],have_file("%s/lib/libjpeg.a"%prefix),
+	"tar xvzf %s; cd jpeg-6b; cp /usr/share/libtool/config.sub .; cp /usr/share/libtool/config.guess .; ./configure --enable-shared --enable-static --prefix=%s; make; make install;ranlib %s/lib/libjpeg.a"%(fsp["jpeg"],prefix,prefix))
 
-# tiff
-if not access("%s/lib/libtiff.%s"%(prefix, DLIB_FILE_EXT), R_OK):
-	system("tar xvzf "+fsp["tiff"])
-	system("cd %s; ./configure --prefix=%s; make; make install"%(fsp["tiff"][:-7],prefix))
+# tiff, configured after jpeg so it finds libjpeg as it always did
+package("tiff",["jpeg"],have_file("%s/lib/libtiff.%s"%(prefix, DLIB_FILE_EXT)),
+	"tar xvzf %s; cd %s; ./configure --prefix=%s; make; make install"%(fsp["tiff"],fsp["tiff"][:-7],prefix),cache=True)
 
 # boost
 if OS == "MAC":
 	# this version is for OSX
-	if system("which bjam") :
-		system("tar xvzf "+fsp["jam"])
-		system("cd %s; ./build.sh; cp bin.macosxx86/bjam %s/bin/"%(fsp["jam"][:-4],prefix))
-		
-		system("tar xvjf "+fsp["boost"])
-		system("cd %s; bjam --toolset=darwin install"%fsp["boost"][:-8])
+	package("boost",[],have_command("bjam"),
+		"tar xvzf %s; cd %s; ./build.sh; cp bin.macosxx86/bjam %s/bin/; cd ..; "%(fsp["jam"],fsp["jam"][:-4],prefix)+
+		"tar xvjf %s; cd %s; bjam --toolset=darwin install"%(fsp["boost"],fsp["boost"][:-8]))
 elif OS == "LINUX":
 	# This version is for Linux x86_64
-	if system("which bjam") :
-		system("tar xvzf "+fsp["jam"])
-		system("cd %s; ./build.sh; cp bin.linuxx86_64//bjam %s/bin/"%(fsp["jam"][:-4],prefix))
-		
-		system("tar xvjf "+fsp["boost"])
-		system("cd %s; bjam --toolset=gcc install"%fsp["boost"][:-8])
+	package("boost",[],have_command("bjam"),
+		"tar xvzf %s; cd %s; ./build.sh; cp bin.linuxx86_64//bjam %s/bin/; cd ..; "%(fsp["jam"],fsp["jam"][:-4],prefix)+
+		"tar xvjf %s; cd %s; bjam --toolset=gcc install"%(fsp["boost"],fsp["boost"][:-8]))
 
 # HDF5
-if not access("%s/lib/libhdf5.%s"%(prefix, DLIB_FILE_EXT), R_OK):
-	system("tar xvzf "+fsp["hdf5"])
-	system("cd %s; ./configure --prefix=%s --with-default-api-version=v16; make; make install"%(fsp["hdf5"][:-7],prefix))
+package("hdf5",[],have_file("%s/lib/libhdf5.%s"%(prefix, DLIB_FILE_EXT)),
+	"tar xvzf %s; cd %s; ./configure --prefix=%s --with-default-api-version=v16; make; make install"%(fsp["hdf5"],fsp["hdf5"][:-7],prefix),cache=True)
 
 # cmake
-if not access("%s/bin/cmake"%prefix,R_OK):
-	system("tar xvzf "+fsp["cmake"])
-	system("cd %s; ./configure --prefix=%s; make; make install"%(fsp["cmake"][:-7],prefix))
+package("cmake",[],have_file("%s/bin/cmake"%prefix),
+	"tar xvzf %s; cd %s; ./configure --prefix=%s; make; make install"%(fsp["cmake"],fsp["cmake"][:-7],prefix),cache=True)
 
 # SIP
-try: import sip
-except:
-	system("tar xvzf "+fsp["sip"])
-	system("cd %s; python configure.py; make; make install"%fsp["sip"][:-7])
+package("sip",[],have_module("sip"),
+	"tar xvzf %s; cd %s; python configure.py; make; make install"%(fsp["sip"],fsp["sip"][:-7]))
 
 # PyQt
-try: import PyQt4
-except:
-	system("tar xvzf "+fsp["pyqt"])
-	system("cd %s; echo 'yes' | python configure.py; make; make install"%fsp["pyqt"][:-7])
+package("pyqt",["sip"],have_module("PyQt4"),
+	"tar xvzf %s; cd %s; echo 'yes' | python configure.py; make; make install"%(fsp["pyqt"],fsp["pyqt"][:-7]))
 
 # PyOpenGL
-try: import OpenGL
-except:
-	system("tar xvzf "+fsp["pyopengl"])
-	system("cd %s; python setup.py install"%fsp["pyopengl"][:-7])
+package("pyopengl",[],have_module("OpenGL"),
+	"tar xvzf %s; cd %s; python setup.py install"%(fsp["pyopengl"],fsp["pyopengl"][:-7]))
 
-try: import matplotlib
-except:
-	system("easy_install matplotlib")
+package("matplotlib",["setup"],have_module("matplotlib"),
+	"easy_install matplotlib")
 
 # GPG
-if not access("%s/bin/gpg"%prefix,R_OK) :
-	system("tar xvjf "+fsp["gpg"])
-	system("cd %s; ./configure --prefix=%s; make; make install"%(fsp["gpg"][:-8],prefix))
+package("gpg",[],have_file("%s/bin/gpg"%prefix),
+	"tar xvjf %s; cd %s; ./configure --prefix=%s; make; make install"%(fsp["gpg"],fsp["gpg"][:-8],prefix),cache=True)
+
+class ArtifactCache:
+	"""Content-addressed archives of package installs, with LRU eviction by size.
+
+	An archive is keyed by the hash of its source tarball, its build
+	commands (which include the configure flags and prefix), the compiler
+	version and the platform. Each archive has a .sha256 file that is
+	checked before it is restored. Several installs may share a cache, so
+	entries are only published, opened and evicted while holding the lock.
+	"""
+	def __init__(self,directory,maxsize):
+		self.directory=directory
+		self.maxsize=maxsize
+		self.lock=threading.Lock()
+		if not access(directory,F_OK): makedirs(directory)
+		self.lockfile=os.path.join(directory,".lock")
+		self.compiler=popen("cc --version 2>&1").read()
+
+	def key(self,name,commands):
+		h=hashlib.sha256()
+		h.update(json.dumps([sha256sum(fsp[name]),commands,self.compiler,platform.platform()]))
+		return "%s-%s"%(name,h.hexdigest()[:32])
+
+	@contextlib.contextmanager
+	def locked(self):
+		"""Hold the cache against the other threads and processes using it."""
+		with self.lock:
+			f=file(self.lockfile,"a")
+			try:
+				fcntl.flock(f,fcntl.LOCK_EX)
+				yield
+			finally: f.close()
+
+	def restore(self,key,target):
+		"""Extract a cached install into target. Returns False if there is no valid archive."""
+		archive=os.path.join(self.directory,key+".tar.gz")
+		with self.locked():
+			if not access(archive,R_OK): return False
+			try: pinned=file(archive+".sha256").read().strip()
+			except IOError: pinned=None
+			if pinned!=sha256sum(archive):
+				say("Corrupt cache entry, removing ",archive)
+				unlink(archive)
+				return False
+			utime(archive,None)	# most recently used
+			# Once open, the archive can be extracted even if it is evicted meanwhile
+			t=tarfile.open(archive)
+		t.extractall(target)
+		t.close()
+		return True
+
+	def store(self,key,source):
+		"""Archive the install in directory source."""
+		archive=os.path.join(self.directory,key+".tar.gz")
+		tmp="%s.%d.tmp"%(archive,getpid())	# another install may be storing the same key
+		t=tarfile.open(tmp,"w:gz")
+		for i in sorted(listdir(source)): t.add(os.path.join(source,i),i)
+		t.close()
+		with self.locked():
+			file(archive+".sha256","w").write(sha256sum(tmp)+"\n")
+			rename(tmp,archive)
+			self.evict(key)
+
+	def evict(self,keep):
+		"""Remove the least recently used archives other than key keep until
+		the cache fits in maxsize bytes. The caller holds the lock."""
+		entries=[os.path.join(self.directory,i) for i in listdir(self.directory) if i.endswith(".tar.gz") and i!=keep+".tar.gz"]
+		entries.sort(key=lambda i: stat(i).st_mtime)
+		total=sum(stat(i).st_size for i in entries)+stat(os.path.join(self.directory,keep+".tar.gz")).st_size
+		while entries and total>self.maxsize:
+			oldest=entries.pop(0)
+			total-=stat(oldest).st_size
+			say("Evicting ",oldest)
+			unlink(oldest)
+			if access(oldest+".sha256",F_OK): unlink(oldest+".sha256")
+
+class Jobserver:
+	"""GNU make jobserver shared by all the builds.
+
+	The pipe holds one token per job slot except one; a build takes a slot
+	before it starts, and its make takes more tokens for parallel jobs.
+	"""
+	def __init__(self,jobs):
+		self.r,self.w=pipe()
+		write(self.w,"+"*(jobs-1))
+		self.free=threading.Lock()	# the slot without a token
+		self.makeflags=" -j --jobserver-fds=%d,%d"%(self.r,self.w)
+	def acquire(self):
+		if self.free.acquire(False): return None
+		return read(self.r,1)
+	def release(self,token):
+		if token is None: self.free.release()
+		else: write(self.w,token)
+
+def build_all(cpus):
+	"""Build the missing packages in dependency order, concurrently. Returns {name:(status,seconds)}."""
+	jobserver=Jobserver(cpus)
+	environ["MAKEFLAGS"]=jobserver.makeflags
+	logs=path+"/logs"
+	if not access(logs,F_OK): makedirs(logs)
+	results={}
+	finished=Queue.Queue()
+
+	def build(name):
+		deps,installed,commands,cache=pkgs[name]
+		start=time.time()
+		key=None
+		if cache and artifacts:
+			key=artifacts.key(name,commands)
+			if artifacts.restore(key,prefix):
+				finished.put((name,"restored from cache",time.time()-start))
+				return
+			# Install into a staging directory, archive it, then restore it into the prefix
+			destdir=os.path.join(path,"destdir",name)
+			if access(destdir,F_OK): shutil.rmtree(destdir)
+			commands="export DESTDIR=%s; %s"%(destdir,commands)
+		token=jobserver.acquire()
+		try:
+			say("Building ",name)
+			if system("(%s) > %s/%s.log 2>&1"%(commands,logs,name)): status="FAILED, see %s/%s.log"%(logs,name)
+			else: status="built"
+		finally:
+			jobserver.release(token)
+		if key and status=="built":
+			staged=os.path.join(destdir,prefix.lstrip("/"))
+			artifacts.store(key,staged)
+			# If the archive cannot be restored, install the staged copy directly
+			if artifacts.restore(key,prefix) or not system("cp -pR %s/. %s"%(staged,prefix)): shutil.rmtree(destdir)
+			else: status="FAILED, could not install %s into %s"%(staged,prefix)
+		finished.put((name,status,time.time()-start))
+
+	waiting=set(pkgs)
+	running=set()
+	while waiting or running:
+		for name in sorted(waiting):
+			deps=pkgs[name][0]
+			if any(d in waiting or d in running for d in deps): continue
+			waiting.remove(name)
+			if [d for d in deps if results[d][0] not in ("installed","built","restored from cache")]:
+				results[name]=("skipped, a dependency failed",0.0)
+			elif pkgs[name][1]():
+				results[name]=("installed",0.0)
+			else:
+				running.add(name)
+				threading.Thread(target=build,args=(name,)).start()
+		if not running: continue
+		name,status,seconds=finished.get()
+		running.remove(name)
+		results[name]=(status,seconds)
+		say("Finished ",name,status)
+	return results
+
+artifacts=None
+if args.cache: artifacts=ArtifactCache(args.cache,int(args.cache_size*2**30))
+results=build_all(args.cpus)
+print "%-12s %8s  %s"%("package","seconds","status")
+for name in sorted(results,key=lambda i: -results[i][1]):
+	print "%-12s %8.0f  %s"%(name,results[name][1],results[name][0])
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""Write the Mach-O fixtures used by test_macho.py.
+
+thin.dylib is an x86_64 dylib; fat.dylib holds an x86_64 and an i386
+slice. Each has a __TEXT segment with one section, LC_ID_DYLIB, two
+LC_LOAD_DYLIB commands, one LC_RPATH and an LC_UUID, with room left
+between the load commands and the section for one more command.
+"""
+import os
+import struct
+
+LC_SEGMENT = 0x1
+LC_LOAD_DYLIB = 0xc
+LC_ID_DYLIB = 0xd
+LC_SEGMENT_64 = 0x19
+LC_UUID = 0x1b
+LC_RPATH = 0x8000001c
+
+TEXT_OFFSET = 0x400
+TEXT = '\x90' * 16
+
+def padded(s, align):
+    s += '\0'
+    return s + '\0' * (-len(s) % align)
+
+def dylib_command(cmd, name, align):
+    s = padded(name, align)
+    return struct.pack('<IIIIII', cmd, 24 + len(s), 24, 2, 0x10000, 0x10000) + s
+
+def segment(is64):
+    if is64:
+        sect = struct.pack('<16s16sQQIIIIIIII', '__text', '__TEXT', TEXT_OFFSET, len(TEXT), TEXT_OFFSET, 0, 0, 0, 0x80000400, 0, 0, 0)
+        return struct.pack('<II16sQQQQIIII', LC_SEGMENT_64, 72 + len(sect), '__TEXT', 0, 0x1000, 0, TEXT_OFFSET + len(TEXT), 5, 5, 1, 0) + sect
+    sect = struct.pack('<16s16sIIIIIIIII', '__text', '__TEXT', TEXT_OFFSET, len(TEXT), TEXT_OFFSET, 0, 0, 0, 0x80000400, 0, 0)
+    return struct.pack('<II16sIIIIIIII', LC_SEGMENT, 56 + len(sect), '__TEXT', 0, 0x1000, 0, TEXT_OFFSET + len(TEXT), 5, 5, 1, 0) + sect
+
+def dylib(is64):
+    align = 8 if is64 else 4
+    rpath = padded('@loader_path/../lib', align)
+    cmds = [
+        segment(is64),
+        dylib_command(LC_ID_DYLIB, '/usr/local/lib/libfixture.dylib', align),
+        dylib_command(LC_LOAD_DYLIB, '/usr/local/lib/libdep.1.dylib', align),
+        dylib_command(LC_LOAD_DYLIB, '/usr/lib/libSystem.B.dylib', align),
+        struct.pack('<III', LC_RPATH, 12 + len(rpath), 12) + rpath,
+        struct.pack('<II', LC_UUID, 24) + ('\x11' if is64 else '\x22') * 16,
+    ]
+    body = ''.join(cmds)
+    if is64:
+        header = struct.pack('<IIIIIIII', 0xfeedfacf, 0x01000007, 3, 6, len(cmds), len(body), 0, 0)
+    else:
+        header = struct.pack('<IIIIIII', 0xfeedface, 7, 3, 6, len(cmds), len(body), 0)
+    data = header + body
+    return data + '\0' * (TEXT_OFFSET - len(data)) + TEXT
+
+def fat(slices):
+    align = 12
+    offset = 1 << align
+    archs, data = [], ''
+    for cputype, body in slices:
+        archs.append(struct.pack('>IIIII', cputype, 3, offset + len(data), len(body), align))
+        data += body + '\0' * (-len(body) % (1 << align))
+    header = struct.pack('>II', 0xcafebabe, len(slices)) + ''.join(archs)
+    return header + '\0' * (offset - len(header)) + data
+
+if __name__ == "__main__":
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(here, 'thin.dylib'), 'wb') as f:
+        f.write(dylib(True))
+    with open(os.path.join(here, 'fat.dylib'), 'wb') as f:
+        f.write(fat([(0x01000007, dylib(True)), (7, dylib(False))]))
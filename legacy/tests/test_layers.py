@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Tests for the layered images written by TarballPackage in build.py.
+
+Run with: python legacy/tests/test_layers.py
+"""
+import imp
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+build = imp.load_source('build', os.path.join(here, '..', 'build.py'))
+
+class LayersTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.epoch = os.environ.get('SOURCE_DATE_EPOCH')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        if self.epoch is None:
+            os.environ.pop('SOURCE_DATE_EPOCH', None)
+        else:
+            os.environ['SOURCE_DATE_EPOCH'] = self.epoch
+
+    def stage(self, root, commit):
+        """A staged install of one commit, with the same extlib every time."""
+        args = build.arguments().parse_args(['--root', root, '--commit', commit, '--profile-entries', '', 'package'])
+        args.cvstag = '2.2'
+        args = build.Linux64Target(args).args
+        args.python = sys.executable
+        sp = os.path.join(args.cwd_rpath, 'extlib', 'lib', 'python2.7', 'site-packages')
+        for d in (os.path.join(args.cwd_rpath, 'lib'), os.path.join(args.cwd_rpath, 'bin'), os.path.join(sp, 'pkg')):
+            os.makedirs(d)
+        with open(os.path.join(args.cwd_rpath, 'lib', 'EMAN2.py'), 'w') as f:
+            f.write('COMMIT = %r\n'%commit)
+        with open(os.path.join(sp, 'pkg', '__init__.py'), 'w') as f:
+            f.write('X = 1\n')
+        with open(os.path.join(sp, 'six.py'), 'w') as f:
+            f.write('Y = 2\n')
+        return args
+
+    def hashes(self, args):
+        """Layer name -> hash of a stage, after compiling it as the package step does."""
+        build.CompilePython(args).run()
+        package = build.TarballPackage(args)
+        db = sqlite3.connect(os.path.join(self.tmp, 'hashes.sqlite'))
+        try:
+            return dict((name, package.layer_hash(root, arcname, exclude, db)) for name, root, arcname, exclude in package.layers())
+        finally:
+            db.close()
+
+    def test_extlib_layer_is_reused_across_commits(self):
+        os.environ['SOURCE_DATE_EPOCH'] = '1000'
+        first = self.hashes(self.stage(os.path.join(self.tmp, 'a'), 'a'*40))
+        os.environ['SOURCE_DATE_EPOCH'] = '2000'
+        second = self.hashes(self.stage(os.path.join(self.tmp, 'b'), 'b'*40))
+        self.assertEqual(sorted(first), ['core', 'extlib'])
+        self.assertEqual(first['extlib'], second['extlib'])
+        self.assertNotEqual(first['core'], second['core'])
+
+if __name__ == "__main__":
+    unittest.main()
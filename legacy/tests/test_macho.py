@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Tests for the MachOFile reader/writer in build.py, run on the dylibs in fixtures/.
+
+Run with: python legacy/tests/test_macho.py
+The fixtures are written by fixtures/make_macho.py.
+"""
+import imp
+import os
+import shutil
+import tempfile
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+build = imp.load_source('build', os.path.join(here, '..', 'build.py'))
+
+FIXTURES = os.path.join(here, 'fixtures')
+
+class MachOTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def copy(self, name):
+        path = os.path.join(self.tmp, name)
+        shutil.copy(os.path.join(FIXTURES, name), path)
+        return path
+
+    def test_classify(self):
+        for name in ('thin.dylib', 'fat.dylib'):
+            self.assertEqual(build.classify(os.path.join(FIXTURES, name)), (build.MACHO, None))
+
+    def test_thin(self):
+        with build.MachOFile(os.path.join(FIXTURES, 'thin.dylib')) as m:
+            self.assertEqual(len(m.slices), 1)
+            self.assertTrue(m.slices[0].is64)
+            self.assertEqual(m.slices[0].uuid, '11'*16)
+            self.assertEqual(m.install_name(), '/usr/local/lib/libfixture.dylib')
+            self.assertEqual(m.dylibs(), ['/usr/local/lib/libdep.1.dylib', '/usr/lib/libSystem.B.dylib'])
+            self.assertEqual(m.rpaths(), ['@loader_path/../lib'])
+
+    def test_fat(self):
+        with build.MachOFile(os.path.join(FIXTURES, 'fat.dylib')) as m:
+            self.assertEqual([s.offset for s in m.slices], [4096, 8192])
+            self.assertEqual([s.is64 for s in m.slices], [True, False])
+            self.assertEqual([s.uuid for s in m.slices], ['11'*16, '22'*16])
+            self.assertEqual(m.install_name(), '/usr/local/lib/libfixture.dylib')
+            self.assertEqual(m.dylibs(), ['/usr/local/lib/libdep.1.dylib', '/usr/lib/libSystem.B.dylib'])
+            self.assertEqual(m.rpaths(), ['@loader_path/../lib'])
+
+    def test_rewrite(self):
+        for name in ('thin.dylib', 'fat.dylib'):
+            path = self.copy(name)
+            with build.MachOFile(path, write=True) as m:
+                self.assertTrue(m.rewrite(install_name='@rpath/libfixture.dylib',
+                    changes={'/usr/local/lib/libdep.1.dylib': '@rpath/libdep.1.dylib'}, rpath='@loader_path/'))
+            with build.MachOFile(path) as m:
+                for s in m.slices:
+                    self.assertEqual(s.string(s.find(build.LC_ID_DYLIB)[0]), '@rpath/libfixture.dylib')
+                    self.assertEqual([s.string(lc) for lc in s.find(*build.LC_LOAD_DYLIBS)], ['@rpath/libdep.1.dylib', '/usr/lib/libSystem.B.dylib'])
+                    self.assertEqual([s.string(lc) for lc in s.find(build.LC_RPATH)], ['@loader_path/../lib', '@loader_path/'])
+
+    def test_rewrite_too_long(self):
+        # Nothing is written when a change does not fit, so install_name_tool can be used instead.
+        for name in ('thin.dylib', 'fat.dylib'):
+            path = self.copy(name)
+            with build.MachOFile(path, write=True) as m:
+                self.assertFalse(m.rewrite(changes={'/usr/lib/libSystem.B.dylib': '/' + 'x'*200}))
+                self.assertFalse(m.rewrite(install_name='@rpath/libfixture.dylib', rpath='/' + 'x'*4000))
+            with open(path, 'rb') as a, open(os.path.join(FIXTURES, name), 'rb') as b:
+                self.assertEqual(a.read(), b.read())
+
+if __name__ == "__main__":
+    unittest.main()